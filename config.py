@@ -19,6 +19,7 @@ import os
 VERSION = "1.0.1"
 output_level = 1
 out_fp = None
+console = True   # 偽ならコンソールに出力しない（バッチのワーカープロセス）
 
 def get_base_dir():
     if getattr(sys, 'frozen', False):
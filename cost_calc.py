@@ -101,6 +101,18 @@ def available_moves_for_side(remaining_moves: int, next_to_move: int, side: int)
     else:
         return remaining_moves // 2
 
+def min_remaining_moves(need_s: int, need_g: int, next_to_move: int) -> int:
+    """
+    次の手番が next_to_move (0=先手,1=後手) のとき、
+    先手が need_s 手、後手が need_g 手を指すのに必要な最小の残り手数を返す。
+    """
+    if next_to_move == 0:
+        need_mover, need_other = need_s, need_g
+    else:
+        need_mover, need_other = need_g, need_s
+    r_mover = 2 * need_mover - 1 if need_mover > 0 else 0
+    return max(r_mover, 2 * need_other)
+
 def kings_required_moves(board: cs.Board, target: cs.Board) -> tuple:
     """
     board 上の双方の玉が target の玉の位置に到達するのに必要な最小手数を返す。
@@ -655,7 +667,8 @@ def corrected_need_moves_count(
         if start_board.piece(sq) != cs.NONE
         and start_board.piece(sq) == target_board.piece(sq)
     }
-    untakeable_sqs = protected_sqs | fixed_rfs
+    fixed_sqs = {file_rank_to_sq(rf // 10, rf % 10) for rf in fixed_rfs}
+    untakeable_sqs = protected_sqs | fixed_sqs
     hand_s, hand_g = start_board.pieces_in_hand
     droppable_pieces_s = set()
     droppable_pieces_g = set()
@@ -726,3 +739,63 @@ def corrected_need_moves_count(
     g_cost += nifu_penalty_for_side(cs.WHITE, piece_costs_g, start_board, untakeable_sqs)
     return s_cost, g_cost
 
+
+def restore_cost(board: cs.Board, sq: int) -> int:
+    """
+    board の sq にある駒が一度動いた（または取られた）あと、
+    同じ駒を sq に置き直すのに同じ側が余分に指す必要がある最小手数を返す。
+    """
+    piece = board.piece(sq)
+    if piece in (cs.BKING, cs.WKING):
+        # 玉は取られず、打ち直せないので、離れて戻る2手が必要
+        return 2
+    pieces = board.pieces
+    pieces[sq] = cs.NONE
+    tmp = board.copy()
+    tmp.set_pieces(pieces, board.pieces_in_hand)
+    if is_promoted(piece):
+        make_cost, move_cost = prom_cost(tmp, piece, sq)
+    else:
+        make_cost, move_cost = unprom_cost(tmp, piece, sq)
+    cost = min(make_cost, move_cost)
+    # 後戻りできる駒は、離れて戻る2手でも復元できる
+    if unpromote(piece) not in (cs.BPAWN, cs.BLANCE, cs.BKNIGHT, cs.WPAWN, cs.WLANCE, cs.WKNIGHT) or is_promoted(piece):
+        cost = min(cost, 2)
+    return cost
+
+def infer_fixed_pieces(
+    start_board: cs.Board,
+    target_board: cs.Board,
+    max_depth: int,
+    fixed_rfs: set[int]
+) -> Optional[set[int]]:
+    """
+    開始局面と指定局面で同じ駒がある地点のうち、max_depth 手の間に
+    動くことも取られることもないと証明できる駒の位置（筋段2桁）を返す。
+    駒が一度でも動く・取られると、その地点の復元に restore_cost 手以上が余分に掛かる。
+    これを盤上手数計算の結果に加えて、その側の指せる手数を超える駒を不動駒とする。
+    max_depth 手では到達できないときは None を返す。
+    """
+    avail_s = available_moves_for_side(max_depth, start_board.turn, 0)
+    avail_g = available_moves_for_side(max_depth, start_board.turn, 1)
+    # 推論した地点はもともと必要手数の計算で保護されるので、1回の計算で足りる
+    need_s, need_g = corrected_need_moves_count(start_board, target_board, avail_s, avail_g, fixed_rfs)
+    if need_s > avail_s or need_g > avail_g:
+        # そもそも到達不能なら推論しない
+        return None
+    inferred = set()
+    for sq in range(81):
+        p = start_board.piece(sq)
+        if p == cs.NONE or p != target_board.piece(sq):
+            continue
+        file, rank = sq_to_file_rank(sq)
+        rf = file * 10 + rank
+        if rf in fixed_rfs:
+            continue
+        if piece_owner(p) == cs.BLACK:
+            slack = avail_s - need_s
+        else:
+            slack = avail_g - need_g
+        if restore_cost(start_board, sq) > slack:
+            inferred.add(rf)
+    return inferred
@@ -0,0 +1,329 @@
+# Structa - Shogi Proof Game Proofer
+# Copyright (C) 2026 Masataka Izumi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import config
+from main import solve, new_result, ProblemError
+
+####################
+# ワーカープロセス
+####################
+COST_TT_CACHE = {}   # 指定局面（手番を除く）と不動駒ごとのコスト計算置換表（ワーカープロセスごと）
+
+def run_job(job_id: str, cfg: dict, input_file: str, output_file: str,
+            time_limit: float, node_limit: int, resume: bool, cancel, events) -> dict:
+    """
+    ワーカープロセスで1問を検討する。進捗と見つかった解は events（Queue）に
+    (job_id, "progress", 進捗) と (job_id, "solution", 解の手順) で送る。
+    コスト計算置換表は DAEMON_COST_CACHE 個の指定局面まで残し、同じ指定局面の問題で使い回す。
+    """
+    config.console = False
+    try:
+        result = solve(
+            cfg, input_file, output_file, time_limit, node_limit, resume, interactive=False,
+            cancel=cancel, progress=lambda info: events.put((job_id, "progress", info)),
+            cost_tt_cache=COST_TT_CACHE, solution=lambda moves: events.put((job_id, "solution", moves))
+        )
+    except ProblemError as e:
+        result = new_result(input_file, output_file)
+        result["error"] = str(e)
+    n_keep = int(cfg.get("DAEMON_COST_CACHE", 4))
+    while len(COST_TT_CACHE) > n_keep:
+        del COST_TT_CACHE[next(iter(COST_TT_CACHE))]
+    return result
+
+####################
+# 検討依頼
+####################
+FINISHED = ("done", "stopped", "interrupted", "cancelled", "error")
+PROBLEM_KEYS = ("START_SFEN", "TARGET_SFEN", "MAX_DEPTH", "LIMIT", "MARGIN", "FIXED_PIECES")   # 問題入力ファイルの項目
+# 依頼ごとに上書きできる config.txt の項目（メモリ・ファイルの場所・プロセスの構成は常駐モードの起動時の設定を使う）
+JOB_CONFIG_KEYS = (
+    "OUTPUT_LEVEL", "ST_POS_OUTPUT_MODE", "TT_REPLACEMENT", "AUTO_FIXED_PIECES", "FORCED_PREFIX_DEPTH",
+    "MOVE_ORDERING", "BATCH_EXPANSION", "DEPTH_SWEEP_ALL", "COUNT_MODE", "COUNT_OUTPUT_MAX",
+)
+
+class Job:
+    """
+    常駐モードの検討依頼。問題ファイル・検討結果ファイル・再開用ファイルは job_dir に置く。
+        status : queued、running、done、stopped（探索の上限で中断）、interrupted、cancelled、error
+        events : 進捗・解・終了の通知（/jobs/ID/events で順に送る）
+    """
+    def __init__(self, job_id: str, job_dir: str, time_limit: float, node_limit: int, overrides: dict):
+        self.id = job_id
+        self.dir = job_dir
+        self.input_file = os.path.join(job_dir, "problem.txt")
+        self.output_file = os.path.join(job_dir, "result.txt")
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+        self.overrides = overrides
+        self.status = "queued"
+        self.resume = False
+        self.cancel = None
+        self.result = None
+        self.events = []
+        self.sent_solutions = set()   # 通知済の解（再開しても同じ解は通知しない）
+        self.changed = asyncio.Event()
+
+    def emit(self, event: dict):
+        self.events.append(event)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def emit_progress(self, info: dict):
+        # 終了の通知より後に届いた進捗は捨てる
+        if self.status == "running":
+            self.emit({"event": "progress", **info})
+
+    def emit_solution(self, moves: list):
+        # 検討中に届いた新しい解だけを通知する
+        if self.status == "running" and tuple(moves) not in self.sent_solutions:
+            self.sent_solutions.add(tuple(moves))
+            self.emit({"event": "solution", "moves": moves})
+
+    def summary(self) -> dict:
+        data = {"id": self.id, "status": self.status}
+        if self.result is not None:
+            data.update({k: v for k, v in self.result.items() if k not in ("status", "input", "output")})
+        return data
+
+####################
+# HTTP サーバ
+####################
+HTTP_REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 409: "Conflict"}
+
+async def send_json(writer: asyncio.StreamWriter, status: int, data):
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    writer.write(
+        f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+        f"Content-Type: application/json; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+
+class SolverDaemon:
+    """
+    常駐モード。HTTP（既定では 127.0.0.1 のみ）で検討依頼を受け付け、concurrency 個のワーカープロセスで検討する。
+    ワーカープロセスは使い回すので、モジュールの読込とコスト計算置換表が問題をまたいで残る。
+        POST /jobs                {"problem": {...}, "config": {...}, "time_limit": 秒, "node_limit": ノード数}
+        GET  /jobs                依頼の一覧
+        GET  /jobs/ID             依頼の状態と結果
+        GET  /jobs/ID/events      進捗・解（見つかるたび）・終了を1行1件の JSON で送り続ける（終了したら閉じる）
+        POST /jobs/ID/cancel      待機中なら取り消し、検討中なら中断する（再開用ファイルを出力する）
+        POST /jobs/ID/resume      中断した依頼を再開用ファイルから再開する
+    problem は問題入力ファイルの項目（PROBLEM_KEYS）、config は config.txt の項目の上書き（JOB_CONFIG_KEYS）。
+    ほかの項目や、改行・= を含む problem の値、正の数でない time_limit・node_limit は受け付けない（400 Bad Request）。
+    """
+    def __init__(self, cfg: dict, concurrency: int, jobs_dir: str):
+        self.cfg = cfg
+        self.concurrency = concurrency
+        self.jobs_dir = jobs_dir
+        self.jobs = {}
+
+    async def run(self, host: str, port: int):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.manager = multiprocessing.Manager()
+        self.events = self.manager.Queue()
+        threading.Thread(target=self.pump_events, daemon=True).start()
+        with ProcessPoolExecutor(self.concurrency) as executor:
+            self.executor = executor
+            for _ in range(self.concurrency):
+                asyncio.create_task(self.worker())
+            server = await asyncio.start_server(self.handle, host, port)
+            print(f"【常駐開始】http://{host}:{port}/jobs、{self.concurrency}プロセス")
+            async with server:
+                await server.serve_forever()
+
+    def pump_events(self):
+        # ワーカープロセスからの進捗と解を依頼の通知に移す（別スレッド）
+        while True:
+            job_id, kind, data = self.events.get()
+            job = self.jobs.get(job_id)
+            if job is not None:
+                emit = job.emit_solution if kind == "solution" else job.emit_progress
+                self.loop.call_soon_threadsafe(emit, data)
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            if job.status != "queued":
+                continue
+            job.status = "running"
+            job.cancel = self.manager.Event()
+            job.emit({"event": "started"})
+            cfg = dict(self.cfg, **job.overrides)
+            try:
+                result = await self.loop.run_in_executor(
+                    self.executor, run_job, job.id, cfg, job.input_file, job.output_file,
+                    job.time_limit, job.node_limit, job.resume, job.cancel, self.events
+                )
+            except Exception as e:
+                result = new_result(job.input_file, job.output_file)
+                result["error"] = str(e)
+            # 数え上げモードの解や、まだ届いていない解は終了の通知の前に送る
+            for moves in result["solutions"]:
+                job.emit_solution(moves)
+            job.result = result
+            job.cancel = None
+            job.status = "cancelled" if result["stop_reason"] == "cancel" else result["status"]
+            job.emit({"event": "finished", **job.summary()})
+            print(f"[{job.id}] {job.status}、検出解数 {result['solution_count']:,}、ノード数 {result['nodes']:,}")
+
+    def submit(self, request: dict) -> Job:
+        problem = request.get("problem")
+        if not isinstance(problem, dict) or "TARGET_SFEN" not in problem:
+            raise ValueError("problem に TARGET_SFEN がありません。")
+        overrides = request.get("config", {})
+        if not isinstance(overrides, dict):
+            raise ValueError("config は項目と値の組で指定してください。")
+        for k in problem:
+            if k not in PROBLEM_KEYS:
+                raise ValueError(f"{k} は問題入力ファイルの項目ではありません。")
+        for k in overrides:
+            if k not in JOB_CONFIG_KEYS:
+                raise ValueError(f"{k} は依頼ごとに設定できる項目ではありません。")
+        time_limit = request.get("time_limit")
+        node_limit = request.get("node_limit")
+        if time_limit is not None and (isinstance(time_limit, bool) or not isinstance(time_limit, (int, float))
+                                       or not time_limit > 0):
+            raise ValueError("time_limit は正の数（秒）で指定してください。")
+        if node_limit is not None and (isinstance(node_limit, bool) or not isinstance(node_limit, int)
+                                       or node_limit <= 0):
+            raise ValueError("node_limit は正の整数で指定してください。")
+        # 問題入力ファイルと同じ形式（Shift-JIS の key = value）で保存する
+        lines = []
+        for k, v in problem.items():
+            v = str(v)
+            if "\n" in v or "\r" in v or "=" in v:
+                raise ValueError(f"{k} の値に改行または = があります。")
+            lines.append(f"{k} = {v}\n")
+        text = "".join(lines).encode("shift_jis")
+        job_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+        job = Job(job_id, job_dir, time_limit, node_limit, {k: str(v) for k, v in overrides.items()})
+        try:
+            with open(job.input_file, "wb") as f:
+                f.write(text)
+        except OSError:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+        self.jobs[job_id] = job
+        self.queue.put_nowait(job)
+        return job
+
+    async def stream_events(self, writer: asyncio.StreamWriter, job: Job):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/x-ndjson; charset=utf-8\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        sent = 0
+        while True:
+            changed = job.changed
+            for event in job.events[sent:]:
+                writer.write(json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n")
+            sent = len(job.events)
+            await writer.drain()
+            if job.status in FINISHED and job.events and job.events[-1]["event"] == "finished":
+                return
+            await changed.wait()
+
+    async def route(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter):
+        parts = [p for p in path.split("?", 1)[0].split("/") if p]
+        if not parts or parts[0] != "jobs":
+            return await send_json(writer, 404, {"error": "not found"})
+        if len(parts) == 1:
+            if method == "GET":
+                return await send_json(writer, 200, [job.summary() for job in self.jobs.values()])
+            if method == "POST":
+                job = self.submit(json.loads(body or b"{}"))
+                return await send_json(writer, 201, job.summary())
+        job = self.jobs.get(parts[1])
+        if job is None:
+            return await send_json(writer, 404, {"error": "not found"})
+        action = parts[2] if len(parts) > 2 else ""
+        if method == "GET" and action == "":
+            return await send_json(writer, 200, job.summary())
+        if method == "GET" and action == "events":
+            return await self.stream_events(writer, job)
+        if method == "POST" and action == "cancel":
+            if job.status == "queued":
+                job.status = "cancelled"
+                job.emit({"event": "finished", **job.summary()})
+            elif job.status == "running":
+                job.cancel.set()
+            else:
+                return await send_json(writer, 409, {"error": f"job is {job.status}"})
+            return await send_json(writer, 200, job.summary())
+        if method == "POST" and action == "resume":
+            if job.status not in ("stopped", "interrupted", "cancelled"):
+                return await send_json(writer, 409, {"error": f"job is {job.status}"})
+            job.status = "queued"
+            job.resume = True
+            job.result = None
+            self.queue.put_nowait(job)
+            return await send_json(writer, 200, job.summary())
+        return await send_json(writer, 404, {"error": "not found"})
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            if len(request_line) < 2:
+                return
+            method, path = request_line[0], request_line[1]
+            try:
+                # ヘッダ・本文の形式の誤りも 400 Bad Request で返す
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1")
+                    if line in ("\r\n", "\n", ""):
+                        break
+                    if ":" not in line:
+                        raise ValueError(f"ヘッダの形式が正しくありません：{line.strip()}")
+                    k, v = line.split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                length = headers.get("content-length", "0")
+                if not length.isdigit():
+                    raise ValueError(f"Content-Length が正しくありません：{length}")
+                body = await reader.readexactly(int(length))
+                await self.route(method, path, body, writer)
+            except (ValueError, TypeError, AttributeError) as e:
+                await send_json(writer, 400, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+def serve(cfg: dict, address: str, concurrency: int, jobs_dir: str):
+    """
+    常駐モードを開始する。address は "ポート" または "ホスト:ポート"（ホストの既定は 127.0.0.1）。
+    """
+    host, _, port = address.rpartition(":")
+    daemon = SolverDaemon(cfg, concurrency, jobs_dir)
+    try:
+        asyncio.run(daemon.run(host or "127.0.0.1", int(port)))
+    except KeyboardInterrupt:
+        print("【常駐終了】")
@@ -13,12 +13,13 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import datetime
 import json
 import os
 import cshogi as cs
 from cshogi import KIF
 import psutil
-from typing import List
+from typing import List, Optional
 import unicodedata as uni
 import config
 from config import VERSION
@@ -48,12 +49,12 @@ def out(msg="", level=1, console=False, file=True, overwrite=False):
     """
     ログ出力用ユーティリティ。
         level : 出力レベル（output_level 以下なら出力）
-        console : 標準出力に出すか
+        console : 標準出力に出すか（config.console が偽なら出さない）
         file : ログファイルに出すか
         overwrite : 進捗表示用（改行しない）
     """
     if config.output_level >= level:
-        if console:
+        if console and config.console:
             if overwrite:
                 print(msg, end="", flush=True)
             else:
@@ -85,6 +86,17 @@ def print_solution_kif(start_board: cs.Board, moves: List[int]) -> None:
         board.push(mv)
         prevmv = mv
 
+def get_moves_kif(moves: List[int]) -> List[str]:
+    """
+    手順をKIF形式の指し手文字列のリストにする。
+    """
+    result = []
+    prevmv = None
+    for mv in moves:
+        result.append(KIF.move_to_kif(mv, prevmv))
+        prevmv = mv
+    return result
+
 def get_width_count(text):
     """
     文字列の横幅取得関数
@@ -148,10 +160,20 @@ def save_resume_file(resume_path: str,
                      margin: int,
                      fixed_rfs: set,
                      completed_first_moves: int,
-                     solutions: list):
+                     solutions: list,
+                     forced_prefix: Optional[list] = None,
+                     move_ordering: int = 0,
+                     start_index: int = 0,
+                     sweep_index: int = 0,
+                     cursor: Optional[dict] = None):
     """
     再開用ファイルをJSON形式で保存する
+    開始局面が複数のときは max_depth と forced_prefix は開始局面ごとのリストになる
+    手数の範囲指定時は max_depth は範囲の文字列（例 "9-13"）、forced_prefix は手数ごとのリストになる
+    cursor は読んでいる初手の中の探索位置（SearchContext.resume_cursor、なければ None）
     """
+    if forced_prefix is None:
+        forced_prefix = []
     solutions_usi = [
         [cs.move_to_usi(mv) for mv in sol]
         for sol in solutions
@@ -167,7 +189,12 @@ def save_resume_file(resume_path: str,
             "fixed_pieces": sorted(list(fixed_rfs)),
         },
         "progress": {
-            "completed_first_moves": completed_first_moves
+            "completed_first_moves": completed_first_moves,
+            "forced_prefix": forced_prefix,
+            "move_ordering": move_ordering,
+            "start_index": start_index,
+            "sweep_index": sweep_index,
+            "cursor": cursor
         },
         "solutions": solutions_usi
     }
@@ -175,3 +202,79 @@ def save_resume_file(resume_path: str,
     with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
     os.replace(tmp_path, resume_path)
+
+def save_batch_summary(summary_path: str,
+                       started: datetime.datetime,
+                       elapsed: float,
+                       jobs: int,
+                       results: List[dict]):
+    """
+    バッチの結果の要約をJSON形式で保存する（解は USI 形式の指し手リスト）
+    """
+    data = {
+        "version": VERSION,
+        "started": started.strftime("%Y-%m-%d %H:%M:%S"),
+        "elapsed": elapsed,
+        "jobs": jobs,
+        "total": {
+            "problems": len(results),
+            "solutions": sum(r["solution_count"] for r in results),
+            "nodes": sum(r["nodes"] for r in results),
+        },
+        "problems": results
+    }
+    tmp_path = summary_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, summary_path)
+
+def save_shard_file(shard_path: str,
+                    problem: dict,
+                    shard: tuple,
+                    status: str,
+                    coverage: List[dict],
+                    counts: list,
+                    solutions: List[dict],
+                    nodes: int,
+                    elapsed: float):
+    """
+    分担（--shard）の検討結果をJSON形式で保存する（--merge で統合する）
+    coverage は探索ごとの並べた初手（USI）と分担した初手のうち読み終えた数、
+    counts は手数・開始局面・指定局面ごとの解数、solutions は手数・開始局面・指定局面の番号と解（USI）
+    """
+    data = {
+        "version": VERSION,
+        "shard": list(shard),
+        "status": status,
+        "problem": problem,
+        "coverage": coverage,
+        "counts": counts,
+        "solutions": solutions,
+        "nodes": nodes,
+        "elapsed": elapsed
+    }
+    tmp_path = shard_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, shard_path)
+
+def match_resume_solution(start_board: cs.Board, sol_usi: List[str], target_boards: List[cs.Board]):
+    """
+    再開用ファイルの解（USI形式）を start_board から再生し、
+    合法手順で到達した指定局面の番号と指し手リストを返す。該当しなければ None。
+    指定局面の手番は開始局面と手数で決まるので、手番をそろえて比較する。
+    """
+    board = start_board.copy()
+    moves = []
+    for usi in sol_usi:
+        mv = board.move_from_usi(usi)
+        if not board.is_legal(mv):
+            return None
+        moves.append(mv)
+        board.push(mv)
+    for i, target_board in enumerate(target_boards):
+        target_tmp = target_board.copy()
+        target_tmp.turn = board.turn
+        if board.zobrist_hash() == target_tmp.zobrist_hash():
+            return i, moves
+    return None
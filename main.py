@@ -21,8 +21,12 @@ import time
 import datetime
 import json
 import argparse
+import itertools
+import glob
+import multiprocessing
 import faulthandler
 faulthandler.enable()
+from typing import List
 import config
 from board_utils import (
     piece_value_to_name,
@@ -33,72 +37,155 @@ from io_utils import (
     out,
     log_system_info,
     print_solution_kif,
+    get_moves_kif,
     get_boards_side_by_side,
     load_debug_sol,
-    save_resume_file
+    save_resume_file,
+    save_batch_summary,
+    save_shard_file,
+    match_resume_solution
 )
 from validation import (
     validate_sfen_has_king,
     validate_two_digits,
+    adjust_target_turn,
+)
+from cost_calc import infer_fixed_pieces
+from search import (
+    FREE_THREADED,
+    SearchContext,
+    find_all_paths_to_target,
+    find_all_paths_parallel,
+    detect_forced_prefix
 )
-from search import find_all_paths_to_target
 
-if __name__ == "__main__":
+EXIT_BUDGET = 3   # 探索時間またはノード数の上限で中断したときの終了コード
+EXIT_STALLED = 4   # 再開しても探索位置が進まないまま上限で中断したときの終了コード
+INI_SFEN = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"  # 実戦初形
+
+class ProblemError(Exception):
+    """
+    探索を始める前の設定・局面のエラー。label はエラーの種類（例 "開始局面エラー"）。
+    """
+    def __init__(self, label: str, error: Exception):
+        super().__init__(f"{label} {error}")
+        self.label = label
+        self.error = error
+
+def new_result(input_file: str, output_file: str) -> dict:
+    """
+    1問の検討結果の要約（バッチの集計ファイルに出力する）。
+        status : done（完了）、stopped（探索の上限で中断）、interrupted（Ctrl+C で中断）、error
+        stalled : 再開したが探索位置が進まないまま上限で中断した（上限を増やさないと終わらない）
+    """
+    return {
+        "input": input_file,
+        "output": output_file,
+        "status": "error",
+        "stop_reason": None,
+        "stalled": False,
+        "error": None,
+        "solution_count": 0,
+        "counts_by_target": [],
+        "solutions": [],
+        "nodes": 0,
+        "elapsed": 0.0,
+    }
+
+def solve(cfg: dict,
+          input_file: str,
+          output_file: str,
+          time_limit: float = None,
+          node_limit: int = None,
+          resume: bool = False,
+          interactive: bool = True,
+          cancel=None,
+          progress=None,
+          cost_tt_cache: dict = None,
+          shard: tuple = None,
+          solution=None) -> dict:
+    """
+    input_file の問題を検討して結果を output_file に追記し、結果の要約（new_result）を返す。
+    cfg は config.txt の内容。探索を始める前のエラーは ProblemError を送出する。
+    interactive が偽なら確認を行わない（再開用ファイルは resume が真のときだけ使い、
+    Ctrl+C で中断したときは再開用ファイルを出力する）。
+    cancel・progress・cost_tt_cache は SearchContext に渡す（常駐モード用）。
+    solution を与えると、新しい解が見つかるたびに解の手順（USI のリスト）で呼ぶ（常駐モード用）。
+    shard = (k, n) のときは初手を n 組に分けた k 組目だけを探索し、分担の検討結果ファイルを出力する。
+    """
     try:
-        # 引数パース
-        parser = argparse.ArgumentParser(description="Structa - Shogi Proof Game Proofer")
-        parser.add_argument( 
-            "-i", "--input",
-            help="入力ファイル名（省略時は config.txt の INPUT_FILE を使用）"
-        )
-        parser.add_argument(
-            "-o", "--output",
-            help="出力ファイル名（省略時は config.txt の OUTPUT_FILE を使用）"
-        )
-        parser.add_argument(
-            "--wait",
-            action="store_true",
-            help="終了時に Enter キー入力を待つ"
-        )
-        parser.add_argument(
-            "--nowait",
-            action="store_true",
-            help="終了時に Enter キー入力を待たない"
-        )
-        args = parser.parse_args()
+        config.out_fp = open(output_file, "a", encoding="utf-8")
+    except Exception as e:
+        raise ProblemError("設定エラー", e)
+    try:
+        return solve_problem(cfg, input_file, output_file, time_limit, node_limit, resume, interactive,
+                             cancel, progress, cost_tt_cache, shard, solution)
+    finally:
+        try:
+            config.out_fp.close()
+        except Exception:
+            pass
 
-        # config.txt の読込
-        cfg = load_kv_file(os.path.join(config.BASE_DIR, "config.txt"))
+def solve_problem(cfg: dict,
+                  input_file: str,
+                  output_file: str,
+                  time_limit: float,
+                  node_limit: int,
+                  resume: bool,
+                  interactive: bool,
+                  cancel,
+                  progress,
+                  cost_tt_cache: dict,
+                  shard: tuple,
+                  solution) -> dict:
+    result = new_result(input_file, output_file)
+    try:
+        # config.txt の設定
         config.output_level = int(cfg.get("OUTPUT_LEVEL", 1))
         st_pos_output_mode = int(cfg.get("ST_POS_OUTPUT_MODE", 1))
         tt_memory_mb = int(cfg.get("TT_MEMORY_MB", 256))
-        cfg_input = cfg.get("INPUT_FILE", "")
-        cfg_output = cfg.get("OUTPUT_FILE", "")
-        if args.input:
-            input_file = os.path.join(config.BASE_DIR, args.input)
-        else:
-            input_file = os.path.join(config.BASE_DIR, cfg_input)
-
-        if args.output:
-            output_file = os.path.join(config.BASE_DIR, args.output)
-        else:
-            output_file = os.path.join(config.BASE_DIR, cfg_output)
-        if not input_file:
-            raise ValueError("入力ファイルが指定されていません。")
-        if not output_file:
-            raise ValueError("出力ファイルが指定されていません。")
-        
-
-        # 出力先設定
-        config.out_fp = open(output_file, "a", encoding="utf-8")
+        memory_governor = int(cfg.get("MEMORY_GOVERNOR", 1))
+        tt_replacement = cfg.get("TT_REPLACEMENT", "lru")
+        tt_disk_mb = int(cfg.get("TT_DISK_MB", 0))
+        tt_disk_dir = cfg.get("TT_DISK_DIR", "")
+        auto_fixed_pieces = int(cfg.get("AUTO_FIXED_PIECES", 1))
+        forced_prefix_depth = int(cfg.get("FORCED_PREFIX_DEPTH", 2))
+        move_ordering = int(cfg.get("MOVE_ORDERING", 0))
+        batch_expansion = int(cfg.get("BATCH_EXPANSION", 0))
+        depth_sweep_all = int(cfg.get("DEPTH_SWEEP_ALL", 0))
+        count_mode = int(cfg.get("COUNT_MODE", 0))
+        count_output_max = int(cfg.get("COUNT_OUTPUT_MAX", 10))
+        # GIL のない Python ではスレッドで並列に探索する（分担時は分担の中では並列にしない）
+        search_threads = int(cfg.get("SEARCH_THREADS", 1)) or os.cpu_count() or 1
+        threads = search_threads if FREE_THREADED and shard is None else 1
 
         # 入力ファイルの読込
         prob = load_kv_file(input_file)
         start_sfen = prob.get("START_SFEN", "")
+        start_sfens = [x.strip() for x in start_sfen.split(",")]
         target_sfen = prob["TARGET_SFEN"]
-        max_depth = int(prob["MAX_DEPTH"])
+        target_sfens = [x.strip() for x in target_sfen.split(",") if x.strip()]
+        depth_text = prob["MAX_DEPTH"].strip()
+        if "-" in depth_text:
+            # 手数の範囲指定（例 9-13）：短い手数から順に検討する
+            lo, hi = (int(x) for x in depth_text.split("-", 1))
+            if lo > hi:
+                raise ValueError(f"{input_file} の MAX_DEPTH の範囲が正しくありません。")
+            depth_steps = [[d] * len(start_sfens) for d in range(lo, hi + 1)]
+            depth_text = f"{lo}-{hi}"
+        else:
+            # 開始局面が複数のときは MAX_DEPTH も開始局面ごとにカンマ区切りで指定できる（1つなら全開始局面で共通）
+            max_depths = [int(x) for x in depth_text.split(",")]
+            if len(max_depths) == 1:
+                max_depths = max_depths * len(start_sfens)
+            if len(max_depths) != len(start_sfens):
+                raise ValueError(f"{input_file} の MAX_DEPTH の数が START_SFEN の数と一致しません。")
+            depth_steps = [max_depths]
+        depth_sweep = len(depth_steps) > 1
+        max_depths = depth_steps[0]
+        max_depth = max(depth_steps[-1])
         limit = int(prob["LIMIT"])
-        margin = int(prob["MARGIN"])
+        margin = int(prob.get("MARGIN", 0))
         fixed_rfs = set()
         if "FIXED_PIECES" in prob and prob["FIXED_PIECES"]:
             fixed_rfs = {int(x.strip()) for x in prob["FIXED_PIECES"].split(",")}
@@ -106,7 +193,7 @@ if __name__ == "__main__":
             raise ValueError(f"{input_file} に TARGET_SFEN が設定されていません。")
         if not max_depth:
             raise ValueError(f"{input_file} に MAX_DEPTH が設定されていません。")
-        if max_depth <= 0:
+        if min(depth_steps[0]) <= 0:
             raise ValueError(f"{input_file} の MAX_DEPTH は 1 以上である必要があります。")
         if not limit:
             raise ValueError(f"{input_file} に LIMIT が設定されていません。")
@@ -116,12 +203,9 @@ if __name__ == "__main__":
         # デバッグ用
         debug_usis = load_debug_sol(input_file)
     except Exception as e:
-        print("設定エラー", e)
-        sys.exit(1)
-    
-    INI_SFEN = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"  # 実戦初形
-    if not start_sfen:
-        start_sfen = INI_SFEN
+        raise ProblemError("設定エラー", e)
+
+    start_sfens = [sfen if sfen else INI_SFEN for sfen in start_sfens]
     # 解数上限は1～10
     if limit > 10:
         limit = 10
@@ -133,85 +217,209 @@ if __name__ == "__main__":
 
     display_fixed_rfs = {}
     try:
-        validate_sfen_has_king(start_sfen)
-        start = cs.Board(start_sfen)
+        starts = []
+        for sfen in start_sfens:
+            validate_sfen_has_king(sfen)
+            starts.append(cs.Board(sfen))
     except Exception as e:
-        print("開始局面エラー", e)
-        sys.exit(1)
+        raise ProblemError("開始局面エラー", e)
+    start = starts[0]
     try:
-        validate_sfen_has_king(target_sfen)
-        target = cs.Board(target_sfen)
+        targets = []
+        for sfen in target_sfens:
+            validate_sfen_has_king(sfen)
+            target = cs.Board(sfen)
+            adjust_target_turn(start, target, max_depths[0])
+            targets.append(target)
     except Exception as e:
-        print("指定局面エラー", e)
-        sys.exit(1)
+        raise ProblemError("指定局面エラー", e)
     try:
         for x in fixed_rfs:
             r, f = validate_two_digits(x)
+            # 開始局面が複数のときはすべての開始局面に駒が必要
+            for st in starts:
+                if st.piece(file_rank_to_sq(r, f)) == 0:
+                    raise ValueError(f"{x}に駒がありません。")
             p = start.piece(file_rank_to_sq(r, f))
-            if p == 0:
-                raise ValueError(f"{x}に駒がありません。")
             name = piece_value_to_name(p)
             side = name[:2]
             piece = name[-1]
             display_fixed_rfs[x] = f"{side}{x}{piece}"
     except Exception as e:
-        print("不動駒設定エラー", e)
-        sys.exit(1)
-    
+        raise ProblemError("不動駒設定エラー", e)
+
+    # 不動駒の自動推論
+    auto_fixed_rfs = set()
+    display_auto_fixed_rfs = {}
+    if auto_fixed_pieces:
+        # すべての開始局面・手数・指定局面の組で不動の駒だけを使う（置換表を共有するため）
+        # 到達できない組は解がなく推論もできないので除く
+        inferred = [
+            infer_fixed_pieces(st, target, depth, fixed_rfs)
+            for depths in depth_steps
+            for st, depth in zip(starts, depths)
+            for target in targets
+        ]
+        inferred = [x for x in inferred if x is not None]
+        if inferred:
+            auto_fixed_rfs = set.intersection(*inferred)
+        for x in sorted(auto_fixed_rfs):
+            name = piece_value_to_name(start.piece(file_rank_to_sq(x // 10, x % 10)))
+            display_auto_fixed_rfs[x] = f"{name[:2]}{x}{name[-1]}"
+
+    # 確定手順の検出（手数・開始局面ごと）
+    forced_prefixes_by_step = []
+    for depths in depth_steps:
+        forced_prefixes = []
+        for st, depth in zip(starts, depths):
+            forced_prefix = []
+            if forced_prefix_depth > 0:
+                # 指定局面ごとの確定手順の共通部分
+                for i, target in enumerate(targets):
+                    adjust_target_turn(st, target, depth)
+                    prefix = detect_forced_prefix(st, target, depth, fixed_rfs | auto_fixed_rfs, forced_prefix_depth)
+                    if i == 0:
+                        forced_prefix = prefix
+                    else:
+                        n = 0
+                        while n < min(len(forced_prefix), len(prefix)) and forced_prefix[n] == prefix[n]:
+                            n += 1
+                        forced_prefix = forced_prefix[:n]
+            forced_prefixes.append(forced_prefix)
+        forced_prefixes_by_step.append(forced_prefixes)
+    for target in targets:
+        adjust_target_turn(start, target, max_depths[0])
+    # 再開用ファイルには開始局面が1つで手数が1つのときは従来どおりの形式で保存する
+    resume_forced_prefix = [
+        [[cs.move_to_usi(mv) for mv in prefix] for prefix in forced_prefixes]
+        for forced_prefixes in forced_prefixes_by_step
+    ]
+    if len(starts) == 1:
+        resume_forced_prefix = [prefixes[0] for prefixes in resume_forced_prefix]
+    if not depth_sweep:
+        resume_forced_prefix = resume_forced_prefix[0]
+    if depth_sweep:
+        resume_max_depth = depth_text
+    elif len(starts) == 1:
+        resume_max_depth = max_depths[0]
+    else:
+        resume_max_depth = max_depths
+
     dt_now = datetime.datetime.now()
     out('【開始】' + 'Structa ' + config.VERSION + ', ' + dt_now.strftime('%Y-%m-%d %H:%M:%S'), 0, console=True)
     out(f"入力ファイル：{input_file}", 1)
-    out("開始局面：" + start.sfen(), 0, console=True)
-    out("指定局面：" + target.sfen(), 0, console=True)
-    if st_pos_output_mode == 2:
-        text = "\n".join(get_boards_side_by_side(start, target))
-    elif st_pos_output_mode == 1 and start.sfen() != INI_SFEN:
-        text = "\n".join(get_boards_side_by_side(start, target))
+    for i, st in enumerate(starts):
+        label = "開始局面" if len(starts) == 1 else f"開始局面{i + 1}"
+        out(f"{label}：" + st.sfen(), 0, console=True)
+    for i, target in enumerate(targets):
+        label = "指定局面" if len(targets) == 1 else f"指定局面{i + 1}"
+        out(f"{label}：" + target.sfen(), 0, console=True)
+        if st_pos_output_mode == 2:
+            text = "\n".join(get_boards_side_by_side(start, target))
+        elif st_pos_output_mode == 1 and start.sfen() != INI_SFEN:
+            text = "\n".join(get_boards_side_by_side(start, target))
+        else:
+            text = KIF.board_to_bod(target)
+        out(text, 1, console=True)
+    if depth_sweep:
+        out(f"指定手数：{depth_steps[0][0]}～{depth_steps[-1][0]}", 0, console=True)
     else:
-        text = KIF.board_to_bod(target)
-    out(text, 1, console=True)
-    out("指定手数：" + str(max_depth), 0, console=True)
-    out("解数上限：" + str(limit), 1, console=True)
+        out("指定手数：" + "、".join(str(depth) for depth in max_depths), 0, console=True)
+    if count_mode:
+        out("解数上限：なし（数え上げモード）", 1, console=True)
+    else:
+        out("解数上限：" + str(limit), 1, console=True)
+    if shard is not None:
+        out(f"分担：{shard[0]}/{shard[1]}（初手を{shard[1]}組に分けた{shard[0]}組目を探索）", 0, console=True)
+    if threads > 1:
+        out(f"並列探索：{threads}スレッド", 1, console=True)
     if display_fixed_rfs:
         s = "、".join(display_fixed_rfs.values())
         out(f"不動駒：{s}", 0, console=True)
+    if display_auto_fixed_rfs:
+        s = "、".join(display_auto_fixed_rfs.values())
+        out(f"不動駒（自動）：{s}", 0, console=True)
+    for depths, forced_prefixes in zip(depth_steps, forced_prefixes_by_step):
+        for i, (prefix, depth) in enumerate(zip(forced_prefixes, depths)):
+            if prefix:
+                notes = []
+                if depth_sweep:
+                    notes.append(f"{depth}手")
+                if len(starts) > 1:
+                    notes.append(f"開始局面{i + 1}")
+                label = "確定手順" + (f"（{'、'.join(notes)}）" if notes else "")
+                s = " ".join(get_moves_kif(prefix))
+                out(f"{label}：{s}（残り{depth - len(prefix)}手を探索）", 0, console=True)
     out('--------------------', 1, console=True)
     log_system_info()  # OUTPUT_LEVEL = 3 のときのみ環境情報を出力
 
     # 処理実行
     try:
         # 再開用ファイルのチェック
+        sweep_index = 0
+        start_index = 0
         first_move_index = 0
-        previous_solutions = []
+        resume_cursor = None
+        resume_position = None   # 再開した探索位置（進まなかったことの検出用）
+        previous_solutions = [[[[] for _ in targets] for _ in starts] for _ in depth_steps]
         base_path = os.path.splitext(input_file)[0]
+        if shard is not None:
+            # 分担の再開用ファイル・検討結果ファイルは分担ごとに別にする
+            base_path += f"_shard{shard[0]}of{shard[1]}"
         resume_path = f"{base_path}_resume.json"
-        if os.path.exists(resume_path):
+        if count_mode and os.path.exists(resume_path):
+            out("数え上げモードでは再開用ファイルを使いません。", 0, console=True)
+        elif os.path.exists(resume_path):
             resume_name = os.path.basename(resume_path)
-            print(f"再開用ファイル「{resume_name}」があります。検討を再開しますか？（Y/N）")
-            ans = input().strip().lower()
+            if resume:
+                out(f"再開用ファイル「{resume_name}」から検討を再開します。", 0, console=True)
+                ans = "y"
+            elif not interactive:
+                ans = "n"
+            else:
+                print(f"再開用ファイル「{resume_name}」があります。検討を再開しますか？（Y/N）")
+                try:
+                    ans = input().strip().lower()
+                except EOFError:
+                    ans = "n"
             if ans == "y":
                 with open(resume_path, "r", encoding="utf-8") as f:
                     data = json.load(f)
                 problem = data.get("problem", {})
-                progress = data.get("progress", {})
+                saved = data.get("progress", {})
                 # 整合性チェック
                 sf_ck = (problem.get("start_sfen") == start_sfen)
                 tf_ck = (problem.get("target_sfen") == target_sfen)
-                md_ck = (problem.get("max_depth") == max_depth)
+                md_ck = (problem.get("max_depth") == resume_max_depth)
                 lm_ck = (problem.get("limit") == limit)
-                mg_ck = (problem.get("margin") == margin)
                 fp_ck = (set(problem.get("fixed_pieces", [])) == fixed_rfs)
-                if (sf_ck and tf_ck and md_ck and lm_ck and mg_ck and fp_ck):
-                    first_move_index = progress.get("completed_first_moves", 0)
+                fx_ck = (saved.get("forced_prefix", []) == resume_forced_prefix)
+                mo_ck = (saved.get("move_ordering", 0) == move_ordering)
+                if (sf_ck and tf_ck and md_ck and lm_ck and fp_ck and fx_ck and mo_ck):
+                    sweep_index = saved.get("sweep_index", 0)
+                    start_index = saved.get("start_index", 0)
+                    first_move_index = saved.get("completed_first_moves", 0)
+                    resume_cursor = saved.get("cursor")
+                    resume_position = (sweep_index, start_index, first_move_index, resume_cursor)
                     for sol_usi in data.get("solutions", []):
-                        board_tmp = start.copy()
-                        moves = []
-                        for usi in sol_usi:
-                            mv = board_tmp.move_from_usi(usi)
-                            moves.append(mv)
-                            board_tmp.push(mv)
-                        previous_solutions.append(moves)
-                    if (len(previous_solutions) >= limit):
+                        # 手順が成立し指定局面に到達する手数・開始局面の解として扱う
+                        matched = None
+                        for k, depths in enumerate(depth_steps):
+                            for si, (st, depth) in enumerate(zip(starts, depths)):
+                                if len(sol_usi) != depth:
+                                    continue
+                                matched = match_resume_solution(st, sol_usi, targets)
+                                if matched is not None:
+                                    i, moves = matched
+                                    previous_solutions[k][si][i].append(moves)
+                                    break
+                            if matched is not None:
+                                break
+                    found = [
+                        sum(len(sols_s[i]) for sols_k in previous_solutions for sols_s in sols_k)
+                        for i in range(len(targets))
+                    ]
+                    if all(n >= limit for n in found):
                         out("すでに解数上限に到達しています。", 0, console=True)
                         raise ValueError
                     out("再開用ファイルを使って検討を再開します。", 0, console=True)
@@ -225,10 +433,12 @@ if __name__ == "__main__":
                         out("max_depth 不一致", 0, console=True)
                     if (not lm_ck):
                         out("limit 不一致", 0, console=True)
-                    if (not mg_ck):
-                        out("margin 不一致", 0, console=True)
                     if (not fp_ck):
                         out("fixed_pieces 不一致", 0, console=True)
+                    if (not fx_ck):
+                        out("forced_prefix 不一致", 0, console=True)
+                    if (not mo_ck):
+                        out("move_ordering 不一致", 0, console=True)
                     out("", 0)
                     raise ValueError
             else:
@@ -236,35 +446,186 @@ if __name__ == "__main__":
 
         t0 = time.time()
         out("探索中…", 1, True, False)
-        sols, stats, completed_first_moves, interrupted = find_all_paths_to_target(start, target, max_depth, limit, fixed_rfs, tt_memory_mb, margin, first_move_index, previous_solutions, debug_usis)
-        if interrupted:
+        # 置換表は開始局面・手数をまたいで共有する
+        ctx = SearchContext(
+            targets, fixed_rfs | auto_fixed_rfs, tt_memory_mb,
+            bool(memory_governor), tt_replacement, tt_disk_mb, tt_disk_dir, cost_tt_cache, threads
+        )
+        ctx.set_budget(time_limit, node_limit, cancel)
+        ctx.progress = progress
+        sols_by_step = [[[[] for _ in targets] for _ in starts] for _ in depth_steps]
+        counts_by_step = [[[0 for _ in targets] for _ in starts] for _ in depth_steps]
+        roots_by_step = [[None for _ in starts] for _ in depth_steps]   # 数え上げモード：(探索開始局面, 残り手数)
+        step_reports = []   # (手数, 検出解数, ノード数, 処理時間)
+        shard_coverage = []   # 分担時の探索ごとの初手の範囲
+        interrupted = False
+        for k, (depths, forced_prefixes) in enumerate(zip(depth_steps, forced_prefixes_by_step)):
+            if k < sweep_index:
+                # 再開時に完了済の手数は解だけ引き継ぐ
+                sols_by_step[k] = previous_solutions[k]
+                counts_by_step[k] = [[len(sols_t) for sols_t in sols_s] for sols_s in previous_solutions[k]]
+                for sols_s in previous_solutions[k]:
+                    for tg, sols_t in zip(ctx.targets, sols_s):
+                        tg.found_before += len(sols_t)
+                continue
+            if depth_sweep:
+                out("", 1, console=True, file=False)
+                out(f"{depths[0]}手を探索中…", 1, True, False)
+            t_step = time.time()
+            nodes_step = ctx.total_nodes
+            for si, (st, depth, forced_prefix) in enumerate(zip(starts, depths, forced_prefixes)):
+                n_prefix = len(forced_prefix)
+                resuming = (k == sweep_index)
+                if resuming and si < start_index:
+                    # 再開時に完了済の開始局面は解だけ引き継ぐ
+                    sols_by_step[k][si] = previous_solutions[k][si]
+                    counts_by_step[k][si] = [len(sols_t) for sols_t in previous_solutions[k][si]]
+                    for tg, sols_t in zip(ctx.targets, previous_solutions[k][si]):
+                        tg.found_before += len(sols_t)
+                    continue
+                if len(starts) > 1:
+                    out("", 1, console=True, file=False)
+                    out(f"開始局面{si + 1}を探索中…", 1, True, False)
+                search_start = st.copy()
+                for mv in forced_prefix:
+                    search_start.push(mv)
+                if solution is not None:
+                    ctx.on_solution = lambda sol, prefix=forced_prefix: solution(
+                        [cs.move_to_usi(mv) for mv in list(prefix) + list(sol)]
+                    )
+                if threads > 1:
+                    sols_s, stats, completed_first_moves, interrupted = find_all_paths_parallel(
+                        search_start, ctx, depth - n_prefix, limit,
+                        first_move_index if resuming and si == start_index else 0,
+                        [[sol[n_prefix:] for sol in sols_t] for sols_t in previous_solutions[k][si]], debug_usis[n_prefix:],
+                        bool(move_ordering), bool(batch_expansion), bool(count_mode)
+                    )
+                else:
+                    sols_s, stats, completed_first_moves, interrupted = find_all_paths_to_target(
+                        search_start, ctx, depth - n_prefix, limit,
+                        first_move_index if resuming and si == start_index else 0,
+                        [[sol[n_prefix:] for sol in sols_t] for sols_t in previous_solutions[k][si]], debug_usis[n_prefix:],
+                        bool(move_ordering), bool(batch_expansion), bool(count_mode), shard,
+                        resume_cursor if resuming and si == start_index else None
+                    )
+                if shard is not None:
+                    shard_coverage.append({
+                        "sweep_index": k,
+                        "start_index": si,
+                        "depth": depth,
+                        "forced_prefix": [cs.move_to_usi(mv) for mv in forced_prefix],
+                        "root_moves": ctx.root_moves,
+                        "completed_first_moves": completed_first_moves,
+                        "shard_first_moves": len(ctx.root_moves[shard[0] - 1::shard[1]]),
+                    })
+                if count_mode:
+                    # 解の手順は出力時に解の DAG から取り出す
+                    roots_by_step[k][si] = (search_start, depth - n_prefix)
+                    counts_by_step[k][si] = [tg.solution_count(search_start, depth - n_prefix) for tg in ctx.targets]
+                else:
+                    sols_by_step[k][si] = [[forced_prefix + sol for sol in sols_t] for sols_t in sols_s]
+                    counts_by_step[k][si] = [len(sols_t) for sols_t in sols_s]
+                for tg, n in zip(ctx.targets, counts_by_step[k][si]):
+                    tg.found_before += n
+                if interrupted:
+                    break
+                if not count_mode and all(tg.found_before >= limit for tg in ctx.targets):
+                    break
+            n_step = sum(sum(counts_s) for counts_s in counts_by_step[k])
+            step_reports.append((depths[0], n_step, ctx.total_nodes - nodes_step, time.time() - t_step))
+            if interrupted:
+                break
+            if not count_mode and all(tg.found_before >= limit for tg in ctx.targets):
+                break
+            # 範囲指定時は解が見つかった手数で終了する（DEPTH_SWEEP_ALL = 1 なら残りの手数も検討する）
+            if depth_sweep and n_step > 0 and not depth_sweep_all:
+                break
+        stats = ctx.stats()
+        for target in targets:
+            adjust_target_turn(start, target, max_depths[0])
+        counts_by_target = [
+            sum(counts_s[i] for counts_k in counts_by_step for counts_s in counts_k)
+            for i in range(len(targets))
+        ]
+        sols = [sol for sols_k in sols_by_step for sols_s in sols_k for sols_t in sols_s for sol in sols_t]
+        elapsed = time.time() - t0
+        result["stop_reason"] = ctx.stop_reason
+        result["counts_by_target"] = counts_by_target
+        result["solution_count"] = sum(counts_by_target)
+        result["solutions"] = [[cs.move_to_usi(mv) for mv in sol] for sol in sols]
+        result["nodes"] = stats["total_nodes"]
+        result["elapsed"] = elapsed
+
+        def save_resume():
+            save_resume_file(resume_path, start_sfen, target_sfen, resume_max_depth, limit, margin, fixed_rfs, completed_first_moves, sols, resume_forced_prefix, move_ordering, si, k, ctx.resume_cursor)
+            out(f"再開用ファイルを保存しました：{os.path.basename(resume_path)}", 0, console=True)
+
+        # 探索の上限による中断は確認せずに再開用ファイルを出力し、途中までの結果と統計を出力する
+        stopped = ctx.stop_reason is not None
+        if stopped:
+            reason = {
+                "time": "探索時間の上限に達した",
+                "nodes": "ノード数の上限に達した",
+                "cancel": "キャンセルされた",
+            }[ctx.stop_reason]
             out("", 0, console=True, file=False)
-            print("再開用ファイルを出力しますか？（Y/N）")
-            try:
-                ans = input().strip().lower()
-            except EOFError:
-                ans = "n"
+            out(f"{reason}ため探索を中断しました。", 0, console=True)
+            if count_mode:
+                out("数え上げモードでは再開用ファイルを出力しません。", 0, console=True)
+            else:
+                save_resume()
+                # 並列探索では読み終えた初手の位置から再開するので、1つの初手が上限内に読み終わらないと進まない
+                if resume_position == (k, si, completed_first_moves, ctx.resume_cursor):
+                    result["stalled"] = True
+                    out("前回の中断位置から探索が進みませんでした。探索の上限を増やしてください。", 0, console=True)
+        if interrupted and not stopped and count_mode:
+            out("", 0, console=True, file=False)
+            out("数え上げモードでは再開用ファイルを出力しません。", 0, console=True)
+            out("【中断終了】", 0, console=True)
+            out("", 0)
+            raise KeyboardInterrupt
+        if interrupted and not stopped:
+            out("", 0, console=True, file=False)
+            if interactive:
+                print("再開用ファイルを出力しますか？（Y/N）")
+                try:
+                    ans = input().strip().lower()
+                except EOFError:
+                    ans = "n"
+            else:
+                ans = "y"
             if ans == "y":
-                base_path = os.path.splitext(input_file)[0]
-                resume_path = f"{base_path}_resume.json"
-                resume_file = os.path.basename(resume_path)
-                save_resume_file(resume_path, start_sfen, target_sfen, max_depth, limit, margin, fixed_rfs, completed_first_moves, sols)
-                out(f"再開用ファイルを保存しました：{resume_file}", 0, console=True)
+                save_resume()
             out("【中断終了】", 0, console=True)
             out("", 0)
             raise KeyboardInterrupt
-        elapsed = time.time() - t0
         out("", 0, console=True, file=False)
-        out(f"検出解数：{len(sols)}", 0, console=True)
+        out(f"検出解数：{sum(counts_by_target):,}", 0, console=True)
+        if len(targets) > 1:
+            for i, n in enumerate(counts_by_target, 1):
+                out(f"  指定局面{i}：{n:,}", 0, console=True)
         hours = int(elapsed // 3600)
         minutes = int((elapsed % 3600) // 60)
         seconds = int(elapsed % 60)
         out(f"処理時間：{hours}時間{minutes}分{seconds}秒", 1, console=True)
+        if depth_sweep:
+            out("---- 手数別の探索 ----", 1, console=True)
+            for depth, n_step, nodes_step, sec in step_reports:
+                out(f"{depth}手：検出解数 {n_step}、ノード数 {nodes_step:,}、処理時間 {sec:.1f}秒", 1, console=True)
         
         total = stats["total_nodes"]
         
         def pct(x):
             return f"{(x/total*100):.2f}%"
+
+        def out_tiers(tiers, level):
+            # 2層の置換表の層別統計（L1：直近のエントリ、L2：L1 から追い出したエントリ）
+            out(f"L1 検出数   ：{tiers.get('l1_hits', 0):,}", level)
+            out(f"L2 検出数   ：{tiers.get('l2_hits', 0):,}", level)
+            out(f"昇格回数    ：{tiers.get('promotions', 0):,}", level)
+            out(f"降格回数    ：{tiers.get('demotions', 0):,}", level)
+            out(f"L1 サイズ   ：{tiers.get('l1_size', 0):,} / {tiers.get('l1_max_size', 0):,}", level)
+            out(f"L2 サイズ   ：{tiers.get('l2_size', 0):,} / {tiers.get('l2_slots', 0):,}", level)
         
         out("---- 枝刈り統計 ----", 2)
         out(f"総ノード数  ：{total:,}", 1)
@@ -273,6 +634,11 @@ if __name__ == "__main__":
             f"{stats['pruned_need_moves']:,} ({pct(stats['pruned_need_moves'])})",
             2
         )
+        out(
+            f"駒打ち除外  ："
+            f"{stats['pruned_drops']:,} ({pct(stats['pruned_drops'])})",
+            2
+        )
         out(
             f"先手持駒    ："
             f"{stats['pruned_diff_hand_s']:,} ({pct(stats['pruned_diff_hand_s'])})",
@@ -284,6 +650,16 @@ if __name__ == "__main__":
             2
         )
 
+        out("---- 枝刈り段階 ----", 2)
+        for st in stats["prune_stages"]:
+            rate = (st["rejects"] / st["calls"] * 100) if st["calls"] else 0.0
+            out(
+                f"{st['name']}：呼出 {st['calls']:,}、枝刈り {st['rejects']:,} ({rate:.2f}%)、"
+                f"平均 {st['avg_us']:.1f} μs",
+                2
+            )
+        out(f"実行順の変更回数：{stats['prune_stage_reorders']:,}", 2)
+
         out("---- 手数別 ----", 2)
         for d, c in enumerate(stats["pruned_by_depth"]):
             out(f"{d}手目での枝刈り：{c:,}", 2)
@@ -302,11 +678,30 @@ if __name__ == "__main__":
         out(f"ヒット率    ：{hit_rate:.2f} %", 2)
         out(f"新規登録数  ：{tt_stores:,}", 2)
         out(f"更新回数    ：{tt_updates:,}", 2)
+        out(f"置換方式    ：{stats.get('tt_replacement', 'lru')}", 2)
         out(f"追い出し回数：{tt_evictions:,}", 2)
+        if tt_evictions:
+            evicted_depth = stats["tt_tiers"].get("evicted_depth_sum", 0) / tt_evictions
+            out(f"追い出した記録の平均残り手数：{evicted_depth:.2f}", 2)
         out(f"最終サイズ  ：{tt_size:,}", 2)
         out(f"登録数上限  ：{tt_max_size:,}", 2)
         out(f"メモリ上限  ：{tt_memory_mb:,} MB", 2)
-        out(f"ヒット猶予  ：{margin}手", 2)
+        out_tiers(stats.get("tt_tiers", {}), 2)
+        if tt_disk_mb > 0:
+            tiers = stats.get("tt_tiers", {})
+            out(f"ディスク層  ：{tiers.get('disk_size', 0):,} / {tiers.get('disk_slots', 0):,}（{tt_disk_mb:,} MB）", 2)
+            out(f"ディスク書込：{tiers.get('disk_writes', 0):,}（{tiers.get('disk_flushes', 0):,} 回）", 2)
+            out(f"ディスク参照：{tiers.get('disk_probes', 0):,}（検出 {tiers.get('disk_hits', 0):,}、"
+                f"フィルタで除外 {tiers.get('disk_filtered', 0):,}）", 2)
+            out(f"ディスク追出：{tiers.get('disk_evictions', 0):,}", 2)
+            out(f"フィルタ    ：{tiers.get('bloom_bytes', 0) // 1024:,} KB", 2)
+        gov = stats.get("memory_governor")
+        if gov:
+            out(f"メモリ計測回数：{gov['samples']:,}", 2)
+            out(f"メモリ調整回数：{gov['adjustments']:,}", 2)
+            out(f"最大 RSS    ：{gov['max_rss'] // 2**20:,} MB", 2)
+            out(f"L1 1件の実測：{gov['bytes_per_entry']:.0f} bytes", 2)
+            out(f"L1 配分     ：到達不能 {1 - gov['cost_ratio']:.2f} / コスト計算 {gov['cost_ratio']:.2f}", 2)
         out("---- コスト計算 TT ----", 3)
         cost_lookups = stats.get("cost_tt_lookups", 0)
         cost_hits = stats.get("cost_tt_hits", 0)
@@ -318,33 +713,510 @@ if __name__ == "__main__":
         out(f"ヒット率    ：{hit_rate:.2f} %", 3)
         out(f"最終サイズ  ：{cost_size:,}", 3)
         out(f"登録数上限  ：{cost_max:,}", 3)
+        out_tiers(stats.get("cost_tt_tiers", {}), 3)
+        if count_mode:
+            out("---- 解の DAG ----", 2)
+            out(f"登録局面数  ：{stats.get('solution_dag_size', 0):,}", 2)
 
-        for idx, sol in enumerate(sols, 1):
-            out(f"=== 解 #{idx} ===", 0)
-            print_solution_kif(start, sol)
+        # 数え上げモードでは COUNT_OUTPUT_MAX 個まで（0 ならすべて）を解の DAG から順に出力する
+        n_output = 0
+        printed = []
+        shard_solutions = []
+        for k, (depths, sols_k) in enumerate(zip(depth_steps, sols_by_step)):
+            for si, (st, depth, sols_s) in enumerate(zip(starts, depths, sols_k), 1):
+                for i, sols_t in enumerate(sols_s, 1):
+                    if count_mode and roots_by_step[k][si - 1] is not None:
+                        forced_prefix = forced_prefixes_by_step[k][si - 1]
+                        sols_t = (forced_prefix + list(sol) for sol in ctx.targets[i - 1].iter_solutions(*roots_by_step[k][si - 1]))
+                        if count_output_max > 0:
+                            sols_t = itertools.islice(sols_t, max(count_output_max - n_output, 0))
+                    for idx, sol in enumerate(sols_t, 1):
+                        n_output += 1
+                        label = f"{depth}手 " if depth_sweep else ""
+                        if len(starts) > 1:
+                            label += f"開始局面{si} "
+                        if len(targets) > 1:
+                            label += f"指定局面{i} "
+                        out(f"=== {label}解 #{idx} ===", 0)
+                        print_solution_kif(st, sol)
+                        printed.append([cs.move_to_usi(mv) for mv in sol])
+                        shard_solutions.append({
+                            "sweep_index": k,
+                            "start_index": si - 1,
+                            "target_index": i - 1,
+                            "moves": printed[-1],
+                        })
+        result["solutions"] = printed
+        result["status"] = "stopped" if stopped else "done"
+        if shard is not None:
+            shard_path = f"{base_path}.json"
+            shard_problem = {
+                "start_sfen": start_sfen,
+                "target_sfen": target_sfen,
+                "max_depth": resume_max_depth,
+                "limit": limit,
+                "margin": margin,
+                "fixed_pieces": sorted(fixed_rfs),
+                "move_ordering": move_ordering,
+                "depth_sweep_all": depth_sweep_all,
+                "count_mode": count_mode,
+                "count_output_max": count_output_max,
+            }
+            save_shard_file(shard_path, shard_problem, shard, result["status"], shard_coverage,
+                            counts_by_step, shard_solutions, stats["total_nodes"], elapsed)
+            out(f"分担の検討結果を保存しました：{os.path.basename(shard_path)}", 0, console=True)
 
         dt_now = datetime.datetime.now()
-        out('【終了】' + dt_now.strftime('%Y-%m-%d %H:%M:%S'), 0, console=True)
+        out(('【中断終了】' if stopped else '【終了】') + dt_now.strftime('%Y-%m-%d %H:%M:%S'), 0, console=True)
         out("", 0, console=True)
     except ValueError as e:
-        print("入力値エラー:", e)
+        result["error"] = str(e)
+        if interactive:
+            print("入力値エラー:", e)
     except KeyboardInterrupt:
-        pass
-    finally:
+        result["status"] = "interrupted"
+    return result
+
+####################
+# バッチ
+####################
+def find_problem_files(pattern: str) -> List[str]:
+    """
+    ディレクトリ（中の *.txt）またはワイルドカードに一致する問題ファイルを名前順に返す。
+    config.txt と検討結果ファイル（*_result.txt）は除く。
+    """
+    path = os.path.join(config.BASE_DIR, pattern)
+    if os.path.isdir(path):
+        files = glob.glob(os.path.join(path, "*.txt"))
+    else:
+        files = glob.glob(path)
+    return sorted(
+        f for f in files
+        if os.path.basename(f) != "config.txt" and not f.endswith("_result.txt")
+    )
+
+def solve_batch_item(item: tuple) -> dict:
+    """
+    ワーカープロセスで1問を検討する。コンソールには出力しない。
+    """
+    cfg, input_file, output_file, time_limit, node_limit, resume = item
+    config.console = False
+    try:
+        return solve(cfg, input_file, output_file, time_limit, node_limit, resume, interactive=False)
+    except ProblemError as e:
+        result = new_result(input_file, output_file)
+        result["error"] = str(e)
+        return result
+
+BATCH_STATUS_NAMES = {
+    "done": "完了",
+    "stopped": "中断（上限）",
+    "interrupted": "中断",
+    "error": "エラー",
+}
+
+def run_batch(cfg: dict,
+              pattern: str,
+              output_dir: str,
+              jobs: int,
+              summary_file: str,
+              time_limit: float = None,
+              node_limit: int = None,
+              resume: bool = False) -> int:
+    """
+    pattern に一致する問題ファイルをプロセスプールで並列に検討し、終了コードを返す。
+    検討結果は問題ごとに「問題ファイル名_result.txt」（output_dir、空なら問題ファイルと同じディレクトリ）に出力し、
+    結果の要約を summary_file（JSON）に出力する。
+    ワーカープロセスは使い回すので、モジュールの読込は各プロセスで1回だけ行う。
+    """
+    files = find_problem_files(pattern)
+    if not files:
+        print(f"問題ファイルがありません：{pattern}")
+        return 1
+    items = []
+    for input_file in files:
+        stem = os.path.splitext(os.path.basename(input_file))[0]
+        out_dir = output_dir or os.path.dirname(input_file)
+        items.append((cfg, input_file, os.path.join(out_dir, f"{stem}_result.txt"), time_limit, node_limit, resume))
+    jobs = min(jobs or os.cpu_count() or 1, len(items))
+
+    started = datetime.datetime.now()
+    print(f"【バッチ開始】{started.strftime('%Y-%m-%d %H:%M:%S')}、{len(items)}問、{jobs}プロセス")
+    t0 = time.time()
+    results = []
+    with multiprocessing.Pool(jobs) as pool:
         try:
-            config.out_fp.close()
-        except Exception:
-            pass
-    
+            for result in pool.imap_unordered(solve_batch_item, items):
+                results.append(result)
+                name = os.path.basename(result["input"])
+                status = BATCH_STATUS_NAMES[result["status"]]
+                if result["status"] == "error":
+                    print(f"[{len(results)}/{len(items)}] {name}：{status} {result['error']}")
+                else:
+                    print(
+                        f"[{len(results)}/{len(items)}] {name}：{status}、検出解数 {result['solution_count']:,}、"
+                        f"ノード数 {result['nodes']:,}、処理時間 {result['elapsed']:.1f}秒"
+                    )
+        except KeyboardInterrupt:
+            pool.terminate()
+            print("バッチを中断しました。")
+    results.sort(key=lambda r: r["input"])
+    summary_path = os.path.join(config.BASE_DIR, summary_file)
+    save_batch_summary(summary_path, started, time.time() - t0, jobs, results)
+    print(f"集計ファイルを保存しました：{summary_path}")
+    print(f"【バッチ終了】{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    statuses = {r["status"] for r in results}
+    if len(results) < len(items) or "error" in statuses:
+        return 1
+    if any(r["stalled"] for r in results):
+        return EXIT_STALLED
+    if "stopped" in statuses:
+        return EXIT_BUDGET
+    return 0
+
+####################
+# 分担・並列探索
+####################
+def parse_shard(text: str) -> tuple:
+    """
+    --shard の "k/N" を (k, N) にする。
+    """
+    k, n = (int(x) for x in text.split("/"))
+    if not 1 <= k <= n:
+        raise ValueError(f"--shard は 1/N～N/N の形式で指定してください：{text}")
+    return k, n
+
+def merge_shards(cfg: dict, patterns: List[str], output_file: str) -> int:
+    """
+    分担（--shard）の検討結果ファイルを統合し、通常の検討結果と同じ形式で output_file に追記して終了コードを返す。
+    解は分担しない場合と同じ順（手数・開始局面・指定局面・並べた初手の順）に並べ、指定局面ごとに LIMIT 個まで出力する。
+    各分担は自分の初手の範囲で LIMIT 個まで探すので、統合した先頭 LIMIT 個は分担しない場合の解と一致する。
+    """
+    files = sorted({f for pattern in patterns for f in glob.glob(os.path.join(config.BASE_DIR, pattern))})
+    if not files:
+        print("分担の検討結果ファイルがありません：" + " ".join(patterns))
+        return 1
+    shards = {}
+    for path in files:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        ref = next(iter(shards.values()), data)
+        k, n = data["shard"]
+        if data["problem"] != ref["problem"] or n != ref["shard"][1]:
+            print(f"問題または分担数が他のファイルと一致しません：{os.path.basename(path)}")
+            return 1
+        if k in shards:
+            print(f"分担 {k}/{n} のファイルが重複しています：{os.path.basename(path)}")
+            return 1
+        shards[k] = data
+    problem = ref["problem"]
+    n_shards = ref["shard"][1]
+    missing = [k for k in range(1, n_shards + 1) if k not in shards]
+    stopped = [k for k in sorted(shards) if shards[k]["status"] != "done"]
+
+    config.output_level = int(cfg.get("OUTPUT_LEVEL", 1))
+    config.out_fp = open(output_file, "a", encoding="utf-8")
+    try:
+        starts = [cs.Board(sfen.strip() or INI_SFEN) for sfen in problem["start_sfen"].split(",")]
+        targets = [cs.Board(sfen.strip()) for sfen in problem["target_sfen"].split(",") if sfen.strip()]
+        max_depth = problem["max_depth"]
+        depth_sweep = isinstance(max_depth, str)
+        limit = problem["limit"]
+        count_mode = problem["count_mode"]
+        count_output_max = problem["count_output_max"]
+
+        dt_now = datetime.datetime.now()
+        out('【統合】' + 'Structa ' + config.VERSION + ', ' + dt_now.strftime('%Y-%m-%d %H:%M:%S'), 0, console=True)
+        for i, st in enumerate(starts):
+            label = "開始局面" if len(starts) == 1 else f"開始局面{i + 1}"
+            out(f"{label}：" + st.sfen(), 0, console=True)
+        for i, target in enumerate(targets):
+            label = "指定局面" if len(targets) == 1 else f"指定局面{i + 1}"
+            out(f"{label}：" + target.sfen(), 0, console=True)
+        if depth_sweep:
+            out(f"指定手数：{max_depth.replace('-', '～')}", 0, console=True)
+        else:
+            out("指定手数：" + "、".join(str(d) for d in (max_depth if isinstance(max_depth, list) else [max_depth])), 0, console=True)
+        if count_mode:
+            out("解数上限：なし（数え上げモード）", 1, console=True)
+        else:
+            out("解数上限：" + str(limit), 1, console=True)
+        for k in range(1, n_shards + 1):
+            if k in shards:
+                d = shards[k]
+                status = BATCH_STATUS_NAMES.get(d["status"], d["status"])
+                n_sols = sum(n for counts_k in d["counts"] for counts_s in counts_k for n in counts_s)
+                out(f"分担 {k}/{n_shards}：{status}、検出解数 {n_sols:,}、ノード数 {d['nodes']:,}、"
+                    f"処理時間 {d['elapsed']:.1f}秒", 0, console=True)
+            else:
+                out(f"分担 {k}/{n_shards}：ファイルなし", 0, console=True)
+        out('--------------------', 1, console=True)
+
+        # 探索ごとの並べた初手の順（再開時に読み終えていた探索は記録がないので USI 順とする）
+        root_orders = {}
+        for d in shards.values():
+            for c in d["coverage"]:
+                order = {usi: j for j, usi in enumerate(c["root_moves"])}
+                root_orders[(c["sweep_index"], c["start_index"])] = (order, len(c["forced_prefix"]))
+        grouped = {}
+        for d in shards.values():
+            for j, sol in enumerate(d["solutions"]):
+                k, si, t = sol["sweep_index"], sol["start_index"], sol["target_index"]
+                order, n_prefix = root_orders.get((k, si), ({}, 0))
+                first_usi = sol["moves"][n_prefix] if len(sol["moves"]) > n_prefix else ""
+                grouped.setdefault((k, si, t), []).append(((order.get(first_usi, len(order)), first_usi, j), sol["moves"]))
+
+        # 分担しない場合と同じ順に解数上限・手数の範囲指定の打ち切りを適用する
+        counts_k = [d["counts"] for d in shards.values()]
+        found = [0] * len(targets)
+        counts_by_target = [0] * len(targets)
+        merged = []   # (手数の番号, 開始局面の番号, 指定局面の番号, 解)
+        for k in range(len(ref["counts"])):
+            n_step = 0
+            for si in range(len(starts)):
+                for t in range(len(targets)):
+                    sols_t = [moves for _, moves in sorted(grouped.get((k, si, t), []), key=lambda x: x[0])]
+                    if count_mode:
+                        n = sum(counts[k][si][t] for counts in counts_k)
+                        if count_output_max > 0:
+                            sols_t = sols_t[:max(count_output_max - len(merged), 0)]
+                    else:
+                        sols_t = sols_t[:max(limit - found[t], 0)]
+                        n = len(sols_t)
+                    found[t] += n
+                    counts_by_target[t] += n
+                    n_step += n
+                    merged.extend((k, si, t, moves) for moves in sols_t)
+            if not count_mode and all(n >= limit for n in found):
+                break
+            if depth_sweep and n_step > 0 and not problem["depth_sweep_all"]:
+                break
+
+        out(f"検出解数：{sum(counts_by_target):,}", 0, console=True)
+        if len(targets) > 1:
+            for i, n in enumerate(counts_by_target, 1):
+                out(f"  指定局面{i}：{n:,}", 0, console=True)
+        out(f"総ノード数  ：{sum(d['nodes'] for d in shards.values()):,}", 1)
+        idx = 0
+        prev = None
+        for k, si, t, moves in merged:
+            idx = idx + 1 if (k, si, t) == prev else 1
+            prev = (k, si, t)
+            label = f"{int(max_depth.split('-')[0]) + k}手 " if depth_sweep else ""
+            if len(starts) > 1:
+                label += f"開始局面{si + 1} "
+            if len(targets) > 1:
+                label += f"指定局面{t + 1} "
+            out(f"=== {label}解 #{idx} ===", 0)
+            matched = match_resume_solution(starts[si], moves, [targets[t]])
+            if matched is None:
+                out("（指定局面に到達しない手順です）" + " ".join(moves), 0)
+                continue
+            print_solution_kif(starts[si], matched[1])
+
+        incomplete = missing or stopped
+        if incomplete:
+            out("", 0, console=True, file=False)
+            out("読み終えていない分担があるため、読み終えた範囲の解だけを統合しました。", 0, console=True)
+        dt_now = datetime.datetime.now()
+        out(('【中断終了】' if incomplete else '【終了】') + dt_now.strftime('%Y-%m-%d %H:%M:%S'), 0, console=True)
+        out("", 0, console=True)
+    finally:
+        config.out_fp.close()
+    if missing:
+        return 1
+    if stopped:
+        return EXIT_BUDGET
+    return 0
+
+def solve_shard_item(item: tuple) -> dict:
+    """
+    ワーカープロセスで1問の1つの分担を検討する。コンソールと検討結果ファイルには出力しない。
+    """
+    cfg, input_file, shard, time_limit, node_limit, resume = item
+    config.console = False
+    try:
+        return solve(cfg, input_file, os.devnull, time_limit, node_limit, resume, interactive=False, shard=shard)
+    except ProblemError as e:
+        result = new_result(input_file, os.devnull)
+        result["error"] = str(e)
+        return result
+
+def run_parallel(cfg: dict,
+                 input_file: str,
+                 output_file: str,
+                 processes: int,
+                 time_limit: float = None,
+                 node_limit: int = None,
+                 resume: bool = False) -> int:
+    """
+    GIL のある Python で SEARCH_THREADS が 2 以上のときの並列探索。初手を processes 組に分担してプロセスで検討し、
+    分担の検討結果を統合して output_file に出力し、終了コードを返す（置換表はプロセスごとに持つ）。
+    Ctrl+C では各プロセスが再開用ファイルを出力して終わるのを待つ。
+    """
+    items = [(cfg, input_file, (k, processes), time_limit, node_limit, resume) for k in range(1, processes + 1)]
+    print(f"並列探索：{processes}プロセス（初手を分担）")
+    with multiprocessing.Pool(processes) as pool:
+        pending = pool.map_async(solve_shard_item, items)
+        while not pending.ready():
+            try:
+                pending.wait(0.5)
+            except KeyboardInterrupt:
+                pass
+        results = pending.get()
+    for result in results:
+        if result["status"] == "error":
+            print(result["error"])
+            return 1
+    base_path = os.path.splitext(input_file)[0]
+    shard_files = [f"{base_path}_shard{k}of{processes}.json" for k in range(1, processes + 1)]
+    exit_code = merge_shards(cfg, shard_files, output_file)
+    if exit_code == 0:
+        for path in shard_files:
+            os.remove(path)
+    return exit_code
+
+def main():
+    try:
+        # 引数パース
+        parser = argparse.ArgumentParser(description="Structa - Shogi Proof Game Proofer")
+        parser.add_argument( 
+            "-i", "--input",
+            help="入力ファイル名（省略時は config.txt の INPUT_FILE を使用）"
+        )
+        parser.add_argument(
+            "-o", "--output",
+            help="出力ファイル名（省略時は config.txt の OUTPUT_FILE を使用）。--batch のときは出力先ディレクトリ"
+        )
+        parser.add_argument(
+            "--wait",
+            action="store_true",
+            help="終了時に Enter キー入力を待つ"
+        )
+        parser.add_argument(
+            "--nowait",
+            action="store_true",
+            help="終了時に Enter キー入力を待たない"
+        )
+        parser.add_argument(
+            "--time-limit",
+            type=float,
+            help=f"探索時間の上限（秒）。上限に達すると再開用ファイルを出力して終了コード {EXIT_BUDGET} で終了する"
+        )
+        parser.add_argument(
+            "--node-limit",
+            type=int,
+            help=f"探索ノード数の上限。上限に達すると再開用ファイルを出力して終了コード {EXIT_BUDGET} で終了する"
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="再開用ファイルがあれば確認せずに再開する"
+        )
+        parser.add_argument(
+            "--batch",
+            metavar="PATTERN",
+            help="ディレクトリまたはワイルドカード（例 problems/*.txt）に一致する問題ファイルをまとめて検討する"
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=0,
+            help="--batch・--serve で並列に検討する問題数（省略時は CPU の論理コア数）"
+        )
+        parser.add_argument(
+            "--summary",
+            default="batch_summary.json",
+            help="--batch の結果の要約を出力するファイル名（JSON、省略時は batch_summary.json）"
+        )
+        parser.add_argument(
+            "--serve",
+            metavar="[HOST:]PORT",
+            help="常駐モードで起動し、HTTP で検討依頼を受け付ける（ホストの既定は 127.0.0.1）"
+        )
+        parser.add_argument(
+            "--shard",
+            metavar="K/N",
+            help="初手を N 組に分けた K 組目だけを探索し、分担の検討結果ファイル（問題ファイル名_shardKofN.json）を出力する"
+        )
+        parser.add_argument(
+            "--merge",
+            metavar="FILE",
+            nargs="+",
+            help="分担の検討結果ファイル（ワイルドカード可）を統合して出力ファイルに出力する"
+        )
+        args = parser.parse_args()
+
+        # config.txt の読込
+        cfg = load_kv_file(os.path.join(config.BASE_DIR, "config.txt"))
+        shard = parse_shard(args.shard) if args.shard else None
+        if not args.batch and not args.serve:
+            cfg_input = cfg.get("INPUT_FILE", "")
+            cfg_output = cfg.get("OUTPUT_FILE", "")
+            if args.input:
+                input_file = os.path.join(config.BASE_DIR, args.input)
+            else:
+                input_file = os.path.join(config.BASE_DIR, cfg_input)
+
+            if args.output:
+                output_file = os.path.join(config.BASE_DIR, args.output)
+            else:
+                output_file = os.path.join(config.BASE_DIR, cfg_output)
+            if not input_file:
+                raise ValueError("入力ファイルが指定されていません。")
+            if not output_file:
+                raise ValueError("出力ファイルが指定されていません。")
+    except Exception as e:
+        print("設定エラー", e)
+        sys.exit(1)
+
+    if args.serve:
+        # 常駐モード（daemon は main を読み込むのでここで読み込む）
+        import daemon
+        daemon.serve(cfg, args.serve, args.jobs or os.cpu_count() or 1,
+                     os.path.join(config.BASE_DIR, "daemon_jobs"))
+        sys.exit(0)
+
+    exit_code = 0
+    if args.merge:
+        exit_code = merge_shards(cfg, args.merge, output_file)
+    elif args.batch:
+        output_dir = os.path.join(config.BASE_DIR, args.output) if args.output else ""
+        exit_code = run_batch(cfg, args.batch, output_dir, args.jobs, args.summary,
+                              args.time_limit, args.node_limit, args.resume)
+    else:
+        search_threads = int(cfg.get("SEARCH_THREADS", 1)) or os.cpu_count() or 1
+        if search_threads > 1 and not FREE_THREADED and shard is None:
+            exit_code = run_parallel(cfg, input_file, output_file, search_threads,
+                                     args.time_limit, args.node_limit, args.resume)
+        else:
+            try:
+                result = solve(cfg, input_file, output_file, args.time_limit, args.node_limit, args.resume, shard=shard)
+            except ProblemError as e:
+                print(e.label, e.error)
+                sys.exit(1)
+            if result["status"] == "stopped":
+                exit_code = EXIT_STALLED if result["stalled"] else EXIT_BUDGET
+
     # 終了
+    # 探索の上限を指定したとき・バッチ・分担・統合のときは無人実行とみなし、--wait がなければ待たない
     wait_exit = True
     if args.nowait:
         wait_exit = False
     elif args.wait:
         wait_exit = True
+    elif args.time_limit is not None or args.node_limit is not None or args.batch or args.shard or args.merge:
+        wait_exit = False
     if wait_exit:
         print("Enterキーで終了します。")
         try:
             input()
         except EOFError:
             pass
+    if exit_code:
+        sys.exit(exit_code)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
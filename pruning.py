@@ -0,0 +1,191 @@
+# Structa - Shogi Proof Game Proofer
+# Copyright (C) 2026 Masataka Izumi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import cshogi as cs
+from time import perf_counter
+from typing import Callable, Iterable, List, Optional, Tuple
+from board_utils import file_rank_to_sq
+
+# check(board, remain, avail_s, avail_g) -> 枝刈りするなら必要手数の下界、しないなら None
+StageCheck = Callable[[cs.Board, int, int, int], Optional[int]]
+
+class PruneStage:
+    """
+    着手後の局面に対する枝刈り段階。
+        calls, rejects : 実際の実行順での呼出回数・枝刈り回数
+        samples, sample_rejects, sample_sec : 計測時（全段階を実行）の回数・枝刈り回数・所要時間
+    """
+    __slots__ = ("name", "check", "calls", "rejects", "samples", "sample_rejects", "sample_sec")
+
+    def __init__(self, name: str, check: StageCheck):
+        self.name = name
+        self.check = check
+        self.calls = 0
+        self.rejects = 0
+        self.samples = 0
+        self.sample_rejects = 0
+        self.sample_sec = 0.0
+
+    def avg_sec(self) -> float:
+        if self.samples == 0:
+            return 0.0
+        return self.sample_sec / self.samples
+
+    def reject_rate(self) -> float:
+        if self.samples == 0:
+            return 0.0
+        return self.sample_rejects / self.samples
+
+    def priority(self) -> float:
+        """
+        並べ替えの優先度（小さいほど先に実行する）。
+        独立なフィルタの連鎖では、1回あたりのコスト / 枝刈り率 の昇順が期待コスト最小になる。
+        """
+        rate = self.reject_rate()
+        if rate == 0.0:
+            return float("inf")
+        return self.avg_sec() / rate
+
+class PrunePipeline:
+    """
+    枝刈り段階の列。sample_interval 回に1回は全段階を実行して時間と枝刈り率を計測し、
+    reorder_interval 回ごとに計測結果に基づいて段階を並べ替える。
+    計測時も枝刈りの結果は先頭から最初に枝刈りした段階のものとする。
+    """
+    def __init__(self, stages: List[PruneStage], sample_interval: int = 16, reorder_interval: int = 4096):
+        self.stages = list(stages)
+        self.sample_interval = sample_interval
+        self.reorder_interval = reorder_interval
+        self.runs = 0
+        self.reorders = 0
+
+    def run(self, board: cs.Board, remain: int, avail_s: int, avail_g: int) -> Tuple[Optional[PruneStage], Optional[int]]:
+        """
+        各段階を順に適用し、枝刈りした段階とその必要手数の下界を返す。
+        すべて通過した場合は (None, None) を返す。
+        """
+        self.runs += 1
+        if self.runs % self.reorder_interval == 0:
+            self.reorder()
+        if self.runs % self.sample_interval == 0:
+            return self.run_sampled(board, remain, avail_s, avail_g)
+        for stage in self.stages:
+            stage.calls += 1
+            need = stage.check(board, remain, avail_s, avail_g)
+            if need is not None:
+                stage.rejects += 1
+                return stage, need
+        return None, None
+
+    def run_sampled(self, board: cs.Board, remain: int, avail_s: int, avail_g: int) -> Tuple[Optional[PruneStage], Optional[int]]:
+        result = (None, None)
+        for stage in self.stages:
+            t0 = perf_counter()
+            need = stage.check(board, remain, avail_s, avail_g)
+            stage.sample_sec += perf_counter() - t0
+            stage.samples += 1
+            if need is None:
+                continue
+            stage.sample_rejects += 1
+            if result[0] is None:
+                stage.calls += 1
+                stage.rejects += 1
+                result = (stage, need)
+        if result[0] is None:
+            for stage in self.stages:
+                stage.calls += 1
+        return result
+
+    def reorder(self):
+        order = sorted(self.stages, key=lambda st: st.priority())
+        if order != self.stages:
+            self.stages = order
+            self.reorders += 1
+
+    def absorb(self, other: "PrunePipeline"):
+        """
+        別の探索（並列探索の各スレッド）の計測結果を合算する。段階は名前で対応させる。
+        """
+        stages = {st.name: st for st in self.stages}
+        for st in other.stages:
+            mine = stages[st.name]
+            mine.calls += st.calls
+            mine.rejects += st.rejects
+            mine.samples += st.samples
+            mine.sample_rejects += st.sample_rejects
+            mine.sample_sec += st.sample_sec
+        self.runs += other.runs
+        self.reorders += other.reorders
+
+    def stats(self) -> List[dict]:
+        return [
+            {
+                "name": st.name,
+                "calls": st.calls,
+                "rejects": st.rejects,
+                "avg_us": st.avg_sec() * 1e6,
+            }
+            for st in self.stages
+        ]
+
+####################
+# 指し手フィルタ
+####################
+# filter(mv) -> 着手前に除外するなら True
+MoveFilter = Callable[[int], bool]
+
+def square_mask(sqs: Iterable[int]) -> int:
+    """
+    square index (0～80) の集合をビットマスクに変換する。
+    """
+    mask = 0
+    for sq in sqs:
+        mask |= 1 << sq
+    return mask
+
+def fixed_square_mask(fixed_rfs: set) -> int:
+    """
+    不動駒の筋段（例 {13, 19}）をビットマスクに変換する。
+    """
+    return square_mask(file_rank_to_sq(rf // 10, rf % 10) for rf in fixed_rfs)
+
+def move_touches_mask(mv: int, mask: int) -> bool:
+    """
+    mv の移動元または移動先が mask に含まれるかを返す。
+    駒打ちの移動元は 81 以上なので mask には含まれない。
+    """
+    return bool(((mask >> cs.move_from(mv)) | (mask >> cs.move_to(mv))) & 1)
+
+def fixed_piece_filter(fixed_mask: int) -> Optional[MoveFilter]:
+    """
+    不動駒に触れる手を除外するフィルタ。不動駒がなければ None。
+    """
+    if not fixed_mask:
+        return None
+    return lambda mv: move_touches_mask(mv, fixed_mask)
+
+def drop_filter(relevant_kinds: set) -> MoveFilter:
+    """
+    relevant_kinds（HAND_PIECE の集合）に含まれない駒種の駒打ちを除外するフィルタ。
+    """
+    return lambda mv: cs.move_is_drop(mv) and cs.move_drop_hand_piece(mv) not in relevant_kinds
+
+def apply_move_filters(moves: Iterable[int], filters: List[MoveFilter]) -> List[int]:
+    """
+    filters のいずれかで除外される手を取り除いた指し手リストを返す。
+    """
+    if not filters:
+        return list(moves)
+    return [mv for mv in moves if not any(f(mv) for f in filters)]
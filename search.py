@@ -15,127 +15,731 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import cshogi as cs
 from cshogi import KIF
+import copy
 import math
+import sys
+import time
 import datetime
-from collections import OrderedDict
+import threading
+from array import array
 from typing import List
 from io_utils import (
     out
 )
 from validation import (
     adjust_target_turn,
-    validate_piece_counts,
-    is_move_touching_fixed_piece
+    validate_piece_counts
 )
 from board_utils import (
     get_boards_hash_from_usi,
-    m_distance_vec
+    m_distance_vec,
+    piece_owner,
+    piece_to_hand_piece
+)
+from transposition import (
+    MemoryGovernor,
+    TwoTierTable,
+    new_unreachable_tt,
+    new_cost_tt,
+    tt_hit,
+    tt_store,
+    cost_tt_key,
+    cost_tt_get,
+    cost_tt_store
 )
 from cost_calc import (
     available_moves_for_side,
+    min_remaining_moves,
     corrected_need_moves_count
 )
+from pruning import (
+    PruneStage,
+    PrunePipeline,
+    fixed_square_mask,
+    fixed_piece_filter,
+    drop_filter,
+    apply_move_filters
+)
+
+####################
+# 必要手数の下界
+####################
+# 到達不能置換表の need（transposition.py を参照）は、子局面の値から 1 + min で逆算し
+# （子が指定局面そのものなら 0 として扱う）、枝刈りされた子は静的な手数計算の結果と組み合わせる。
+# 同一局面の残り手数の偶奇は常に一致するので、need は偶奇を揃えて保持する。
+def parity_need(need: int, remain: int) -> int:
+    """
+    残り手数 remain の局面について、必要手数の下界 need を remain と同じ偶奇に切り上げる。
+    """
+    if (need - remain) % 2:
+        need += 1
+    return need
+
+def pruned_need(turn: int, remain: int, need_hand_s: int = 0, need_hand_g: int = 0) -> int:
+    """
+    手番 turn、残り手数 remain で枝刈りされた局面（指定局面ではない）の必要手数の下界を返す。
+    枝刈りの判定は残り手数について単調なので、remain 以下では到達できない。
+    持駒の差は残り手数によらない下界なので、これとも組み合わせる。
+    """
+    need = max(remain + 1, min_remaining_moves(need_hand_s, need_hand_g, turn))
+    return parity_need(need, remain)
 
 ####################
-# 置換表操作
+# 解の DAG
 ####################
-def tt_hit(tt: OrderedDict, h: int, remain: int, stats: dict, margin: int) -> bool:
-    stats["lookups"] += 1
-    failed_remain = tt.get(h)
-    if failed_remain is None:
-        return False
-    delta = failed_remain - remain
-    if delta == 0 or delta > margin:
-        stats["hits"] += 1
-        tt.move_to_end(h)
+def iter_dag_solutions(dag: dict, key: tuple):
+    """
+    解の DAG を key からたどり、解の手順（指し手のタプル）を1つずつ返す。
+    子のキーが None の辺は指定局面に到達する最終手。
+    """
+    for mv, child in dag[key][1]:
+        if child is None:
+            yield (mv,)
+        else:
+            for rest in iter_dag_solutions(dag, child):
+                yield (mv,) + rest
+
+####################
+# 確定手順の検出
+####################
+def is_statically_prunable(board: cs.Board, target_board: cs.Board, remain: int, fixed_rfs: set) -> bool:
+    """
+    残り手数 remain の局面 board が、盤上手数計算・持駒チェックで枝刈りされるかを返す。
+    """
+    avail_s = available_moves_for_side(remain, board.turn, 0)
+    avail_g = available_moves_for_side(remain, board.turn, 1)
+    need_s, need_g = corrected_need_moves_count(board, target_board, avail_s, avail_g, fixed_rfs)
+    if need_s > avail_s or need_g > avail_g:
         return True
-    return False
-
-def tt_store(tt: OrderedDict, h: int, remain: int, max_size: int, stats: dict):
-    prev = tt.get(h)
-    if prev is None:
-        tt[h] = remain
-        tt.move_to_end(h)
-        stats["stores"] += 1
-    elif remain > prev:
-        tt[h] = remain
-        tt.move_to_end(h)
-        stats["store_updates"] += 1
-    else:
-        return
-    if len(tt) > max_size:
-        tt.popitem(last=False)
-        stats["evictions"] += 1
-
-def cost_tt_get(cost_tt: OrderedDict, h: tuple, stats: dict):
-    stats["lookups"] += 1
-    v = cost_tt.get(h)
-    if v is not None:
-        stats["hits"] += 1
-        cost_tt.move_to_end(h)
-    return v
-
-def cost_tt_store(cost_tt: OrderedDict, h: tuple, v, max_size: int):
-    cost_tt[h] = v
-    cost_tt.move_to_end(h)
-    if len(cost_tt) > max_size:
-        cost_tt.popitem(last=False)
+    need_hand_s = m_distance_vec(board.pieces_in_hand[0], target_board.pieces_in_hand[0])
+    need_hand_g = m_distance_vec(board.pieces_in_hand[1], target_board.pieces_in_hand[1])
+    return need_hand_s > avail_s or need_hand_g > avail_g
+
+def surviving_moves(board: cs.Board, target_board: cs.Board, remain: int, fixed_rfs: set, probe_depth: int, max_count: int) -> List[int]:
+    """
+    board から指せる手のうち、probe_depth 手先まで枝刈りされない手順が残る手を最大 max_count 個返す。
+    """
+    result = []
+    filters = [f for f in (fixed_piece_filter(fixed_square_mask(fixed_rfs)),) if f]
+    for mv in apply_move_filters(board.legal_moves, filters):
+        board.push(mv)
+        if remain - 1 == 0:
+            alive = board.zobrist_hash() == target_board.zobrist_hash()
+        elif is_statically_prunable(board, target_board, remain - 1, fixed_rfs):
+            alive = False
+        elif probe_depth > 1:
+            alive = bool(surviving_moves(board, target_board, remain - 1, fixed_rfs, probe_depth - 1, 1))
+        else:
+            alive = True
+        board.pop()
+        if alive:
+            result.append(mv)
+            if len(result) >= max_count:
+                break
+    return result
+
+def detect_forced_prefix(start_board: cs.Board, target_board: cs.Board, max_depth: int, fixed_rfs: set, probe_depth: int) -> List[int]:
+    """
+    開始局面から probe_depth 手先まで読み、枝刈りされずに残る初手が1通りしかない間、
+    その手を確定手順として進める。確定手順（残り1手以上を残す）を返す。
+    探索と同じ枝刈り条件を使うので、すべての解はこの手順から始まる。
+    """
+    adjust_target_turn(start_board, target_board, max_depth)
+    board = start_board.copy()
+    prefix = []
+    remain = max_depth
+    while remain > 1:
+        moves = surviving_moves(board, target_board, remain, fixed_rfs, probe_depth, 2)
+        if len(moves) != 1:
+            break
+        board.push(moves[0])
+        prefix.append(moves[0])
+        remain -= 1
+    return prefix
 
 ####################
 # 探索部
 ####################
+INF_NEED = 10**9
+# GIL のない Python（free-threaded build）ならスレッドで並列に探索できる
+FREE_THREADED = not getattr(sys, "_is_gil_enabled", lambda: True)()
+# 到達不能置換表のキーに XOR する指定局面の手番ごとの値
+TT_TURN_SALT = (0, 0x5DEECE66D2B7E151)
+
+class SearchTarget:
+    """
+    指定局面ごとの探索状態（置換表・枝刈り段階・検出した解）。
+    複数の指定局面を1回の探索で扱うときは、指定局面ごとに1つずつ作る。
+    到達不能置換表のエントリは指定局面の手番ごとに別のものとして扱う（開始局面の手番と手数の偶奇で
+    指定局面の手番が変わるため）。キーには局面のハッシュと指定局面の手番ごとの値 tt_salt の XOR を使う。
+    コスト計算置換表は手番によらない。
+    """
+    def __init__(self,
+                 target_board: cs.Board,
+                 fixed_rfs: set,
+                 tt_bytes: int,
+                 cost_tt_bytes: int,
+                 tt_stats: dict,
+                 cost_tt_stats: dict,
+                 tt_replacement: str = "lru",
+                 tt_disk_bytes: int = 0,
+                 tt_disk_dir: str = "",
+                 cost_tt_cache: dict = None,
+                 stripes: int = 1,
+                 shared: "SearchTarget" = None):
+        self.board = target_board
+        self.hand_s = target_board.pieces_in_hand[0]
+        self.hand_g = target_board.pieces_in_hand[1]
+        self.fixed_rfs = fixed_rfs
+        self.stripes = stripes
+        if shared is not None:
+            # 並列探索のスレッドごとの探索状態は置換表だけを共有する
+            self.unreachable_tt = shared.unreachable_tt
+            self.cost_tt = shared.cost_tt
+        else:
+            self.unreachable_tt = new_unreachable_tt(tt_bytes, tt_replacement, tt_disk_bytes, tt_disk_dir, stripes)
+            self.cost_tt = self.reuse_cost_tt(cost_tt_cache, cost_tt_bytes)
+        self.tt_stats = tt_stats
+        self.cost_tt_stats = cost_tt_stats
+        self.solutions = []
+        self.solution_set = set()
+        self.solution_dag = {}  # 数え上げモード：(局面, 残り手数) -> (解の数, ((指し手, 子のキー), ...))
+        self.found_before = 0   # 別の開始局面・手数の探索で検出済の解数
+        self.done = False
+        self.set_turn(target_board.turn)
+
+        # 枝刈り段階（計測結果に応じて実行順を並べ替える）
+        self.stage_need_moves = PruneStage("盤上手数計算", self.check_need_moves)
+        self.stage_hand_s = PruneStage("先手持駒", self.check_hand_s)
+        self.stage_hand_g = PruneStage("後手持駒", self.check_hand_g)
+        self.pipeline = PrunePipeline([self.stage_need_moves, self.stage_hand_s, self.stage_hand_g])
+
+        # 先後別の目標升 (sq, piece, HAND_PIECE)
+        self.wants = [[], []]
+        for sq in range(81):
+            p = target_board.piece(sq)
+            owner = piece_owner(p)
+            if owner in (0, 1):
+                k = piece_to_hand_piece(p)
+                if k is not None:
+                    self.wants[owner].append((sq, p, k))
+
+    def reuse_cost_tt(self, cost_tt_cache: dict, cost_tt_bytes: int) -> TwoTierTable:
+        """
+        コスト計算置換表を返す。cost_tt_cache があれば、同じ指定局面（手番を除く）と不動駒の置換表を使い回す。
+        使い回した置換表は cost_tt_cache の末尾に移す（先頭ほど長く使っていない）。
+        """
+        if cost_tt_cache is None:
+            return new_cost_tt(cost_tt_bytes, self.stripes)
+        parts = self.board.sfen().split()
+        key = (parts[0], parts[2], frozenset(self.fixed_rfs), self.stripes)
+        cost_tt = cost_tt_cache.pop(key, None)
+        if cost_tt is None:
+            cost_tt = new_cost_tt(cost_tt_bytes, self.stripes)
+        else:
+            cost_tt.reset_stats()
+        cost_tt_cache[key] = cost_tt
+        return cost_tt
+
+    def set_turn(self, turn: int):
+        """
+        指定局面の手番を設定し、到達不能置換表のキーをその手番用に切り替える。
+        """
+        self.board.turn = turn
+        self.hash = self.board.zobrist_hash()
+        self.tt_salt = TT_TURN_SALT[turn]
+
+    def reached_limit(self, limit: int) -> bool:
+        return len(self.solutions) + self.found_before >= limit
+
+    def solution_count(self, board: cs.Board, remain: int) -> int:
+        """
+        数え上げモードの探索後、board から remain 手の解の数を返す。
+        """
+        entry = self.solution_dag.get((board.zobrist_hash(), remain))
+        return entry[0] if entry else 0
+
+    def iter_solutions(self, board: cs.Board, remain: int):
+        """
+        数え上げモードの探索後、board から remain 手の解を1つずつ返す（解の DAG をたどる）。
+        """
+        key = (board.zobrist_hash(), remain)
+        if key in self.solution_dag:
+            yield from iter_dag_solutions(self.solution_dag, key)
+
+    def add_solution(self, solution: tuple) -> bool:
+        """
+        解を追加し、新しい解なら True を返す。
+        """
+        if solution in self.solution_set:
+            return False
+        self.solution_set.add(solution)
+        self.solutions.append(list(solution))
+        return True
+
+    def need_moves(self, board: cs.Board, avail_s: int, avail_g: int) -> tuple:
+        # 盤上手数計算（コスト計算置換表を経由）
+        h_cost = cost_tt_key(board.zobrist_hash(), avail_s, avail_g)
+        cached = cost_tt_get(self.cost_tt, h_cost, self.cost_tt_stats)
+        if cached is not None:
+            return cached
+        need_s, need_g = corrected_need_moves_count(board, self.board, avail_s, avail_g, self.fixed_rfs)
+        cost_tt_store(self.cost_tt, h_cost, (need_s, need_g))
+        return need_s, need_g
+
+    def check_need_moves(self, board, remain, avail_s, avail_g):
+        need_s, need_g = self.need_moves(board, avail_s, avail_g)
+        if need_s > avail_s or need_g > avail_g:
+            return pruned_need(board.turn, remain)
+        return None
+
+    def check_hand_s(self, board, remain, avail_s, avail_g):
+        # 先手持駒
+        need_hand_s = m_distance_vec(board.pieces_in_hand[0], self.hand_s)
+        if need_hand_s > avail_s:
+            return pruned_need(board.turn, remain, need_hand_s, 0)
+        return None
+
+    def check_hand_g(self, board, remain, avail_s, avail_g):
+        # 後手持駒
+        need_hand_g = m_distance_vec(board.pieces_in_hand[1], self.hand_g)
+        if need_hand_g > avail_g:
+            return pruned_need(board.turn, remain, 0, need_hand_g)
+        return None
+
+    def hand_diffs(self, board: cs.Board) -> List[int]:
+        return [
+            m_distance_vec(board.pieces_in_hand[0], self.hand_s),
+            m_distance_vec(board.pieces_in_hand[1], self.hand_g),
+        ]
+
+    # 駒打ちの絞り込み
+    # 手番側に余裕がない（必要手数 = 残り手数）とき、着手のたびに必要手数が 1 減らなければならない。
+    # 未達成の目標升に生駒・成駒として置く必要がなく、持駒の超過分でもない駒種を打っても
+    # 必要手数は減らないので、その駒打ちは着手前に除外できる。
+    def relevant_drop_kinds(self, board: cs.Board, remain: int):
+        """
+        手番側に余裕がなければ意味のある駒打ちの駒種を、余裕があれば None を返す。
+        """
+        turn = board.turn
+        hand = board.pieces_in_hand[turn]
+        if not any(hand):
+            return None
+        avail_s = available_moves_for_side(remain, turn, 0)
+        avail_g = available_moves_for_side(remain, turn, 1)
+        need_s, need_g = self.need_moves(board, avail_s, avail_g)
+        if turn == 0 and need_s < avail_s or turn == 1 and need_g < avail_g:
+            return None
+        target_hand = self.board.pieces_in_hand[turn]
+        kinds = {k for k in range(7) if hand[k] > target_hand[k]}
+        for sq, p, k in self.wants[turn]:
+            if board.piece(sq) != p:
+                kinds.add(k)
+        if all(k in kinds for k in range(7) if hand[k]):
+            return None
+        return kinds
+
+def sum_tier_stats(tables: list) -> dict:
+    """
+    指定局面ごとの置換表の層別統計を合計する。
+    """
+    total = {}
+    for table in tables:
+        for k, v in table.stats().items():
+            total[k] = total.get(k, 0) + v
+    return total
+
+class SearchBudgetExceeded(Exception):
+    """
+    探索時間またはノード数の上限に達した。
+    """
+
+class SearchContext:
+    """
+    探索で共有する状態（指定局面ごとの置換表と統計）。
+    開始局面や手数を変えて find_all_paths_to_target を複数回呼ぶときに同じものを渡すと、
+    到達不能置換表とコスト計算置換表を引き継ぐ。
+    置換表の内容は不動駒の設定に依存するので、不動駒もここで固定する。
+    memory_governor が真なら、探索中に実測したメモリ使用量に合わせて置換表の大きさを調整する。
+    tt_replacement は到達不能置換表の L2 の置換方式（transposition.REPLACEMENT_POLICIES）。
+    tt_disk_mb が正なら、到達不能置換表の L2 から追い出したエントリを tt_disk_dir の一時ファイルに格納する。
+    cost_tt_cache（dict）を与えると、コスト計算置換表を呼出元のプロセスで問題をまたいで使い回す。
+    progress に関数を与えると、進捗表示のたびに {"nodes", "percent", "solutions"} を渡して呼ぶ。
+    threads が 2 以上なら、スレッドで共有できる置換表（StripedTable）を作る（find_all_paths_parallel 用）。
+    このときメモリ調整は行わない。
+    """
+    COST_TT_RATIO = 0.4
+    TT_STRIPES = 64             # 並列探索時の置換表のストライプ数
+    CHECK_INTERVAL = 1000       # 探索の上限を判定する間隔（ノード数）
+    GOVERNOR_INTERVAL = 20000   # メモリ使用量を計測する間隔（ノード数）
+
+    def __init__(self, target_boards: List[cs.Board], fixed_rfs: set, tt_memory_mb: int,
+                 memory_governor: bool = False, tt_replacement: str = "lru",
+                 tt_disk_mb: int = 0, tt_disk_dir: str = "", cost_tt_cache: dict = None,
+                 threads: int = 1):
+        # 到達不能置換表・コスト計算置換表（指定局面の数で等分する）
+        n_targets = len(target_boards)
+        total_tt_bytes = tt_memory_mb * 1024 * 1024 // n_targets
+        unreachable_tt_bytes = int(total_tt_bytes * (1.0 - self.COST_TT_RATIO))
+        cost_tt_bytes = total_tt_bytes - unreachable_tt_bytes
+        tt_disk_bytes = tt_disk_mb * 1024 * 1024 // n_targets
+        self.fixed_rfs = fixed_rfs
+        self.tt_replacement = tt_replacement
+        self.threads = threads
+        stripes = self.TT_STRIPES if threads > 1 else 1
+
+        # 統計（呼出をまたいで累積する）
+        self.total_nodes = 0
+        self.pruned_by_depth = []
+        self.tt_stats = {
+            "lookups": 0,
+            "hits": 0,
+            "stores": 0,
+            "store_updates": 0,
+        }
+        self.cost_tt_stats = {
+            "lookups": 0,
+            "hits": 0,
+        }
+        self.pruned_hand_batch = [0, 0]   # 一括展開時に着手前の持駒チェックで枝刈りした数
+        self.pruned_drops = 0
+
+        self.targets = [
+            SearchTarget(target_board, fixed_rfs, unreachable_tt_bytes, cost_tt_bytes,
+                         self.tt_stats, self.cost_tt_stats, tt_replacement,
+                         tt_disk_bytes, tt_disk_dir, cost_tt_cache, stripes)
+            for target_board in target_boards
+        ]
+        # 探索の上限（set_budget で設定する）
+        self.deadline = None
+        self.node_limit = None
+        self.cancel = None
+        self.stop_reason = None   # 上限で中断したとき "time"、"nodes" または "cancel"
+        self.progress = None
+        self.on_solution = None   # 新しい解が見つかるたびに解の手順（指し手のタプル）で呼ぶ（常駐モード用）
+        self.halt = None   # 並列探索で他のスレッドが中断したときにセットされる Event
+        self.show_progress = True
+        self.root_moves = []   # 直前の探索で並べた初手（USI）
+        self.resume_cursor = None   # 直前の探索を上限で中断したときの探索位置（find_all_paths_to_target）
+
+        self.governor = None
+        if memory_governor and threads <= 1:
+            self.governor = MemoryGovernor(
+                [tg.unreachable_tt for tg in self.targets],
+                [tg.cost_tt for tg in self.targets],
+                tt_memory_mb * 1024 * 1024,
+                self.COST_TT_RATIO
+            )
+
+    def set_budget(self, time_limit: float = None, node_limit: int = None, cancel=None):
+        """
+        探索時間（秒、この呼出からの経過時間）とノード数（累計）の上限を設定する。
+        cancel（is_set() を持つもの、例 multiprocessing の Event）がセットされたときも中断する。
+        上限に達すると find_all_paths_to_target は中断し、stop_reason に理由を記録する。
+        """
+        self.deadline = time.time() + time_limit if time_limit is not None else None
+        self.node_limit = node_limit
+        self.cancel = cancel
+
+    def budget_exceeded(self, nodes: int) -> bool:
+        """
+        今回の呼出で nodes ノード読んだ時点で上限に達していれば stop_reason を記録して True を返す。
+        """
+        if self.node_limit is not None and self.total_nodes + nodes >= self.node_limit:
+            self.stop_reason = "nodes"
+        elif self.deadline is not None and time.time() >= self.deadline:
+            self.stop_reason = "time"
+        elif self.cancel is not None and self.cancel.is_set():
+            self.stop_reason = "cancel"
+        elif self.halt is not None and self.halt.is_set():
+            return True
+        return self.stop_reason is not None
+
+    def fork(self) -> "SearchContext":
+        """
+        並列探索のスレッドごとの探索状態を作る。置換表と探索の上限は共有し、
+        指定局面の盤面・解・枝刈り段階・統計はスレッドごとに持つ。ノード数の上限は残りをスレッド数で等分する。
+        """
+        child = copy.copy(self)
+        child.total_nodes = 0
+        child.pruned_by_depth = []
+        child.tt_stats = dict.fromkeys(self.tt_stats, 0)
+        child.cost_tt_stats = dict.fromkeys(self.cost_tt_stats, 0)
+        child.pruned_hand_batch = [0, 0]
+        child.pruned_drops = 0
+        child.targets = [
+            SearchTarget(tg.board.copy(), self.fixed_rfs, 0, 0, child.tt_stats, child.cost_tt_stats,
+                         self.tt_replacement, shared=tg)
+            for tg in self.targets
+        ]
+        for tg, parent in zip(child.targets, self.targets):
+            tg.found_before = parent.found_before
+        if self.node_limit is not None:
+            child.node_limit = max(1, (self.node_limit - self.total_nodes) // self.threads)
+        child.governor = None
+        child.on_solution = None   # 解は並べ直してから親で通知する
+        return child
+
+    def absorb(self, child: "SearchContext"):
+        """
+        fork した探索状態の統計を合算する。
+        """
+        self.total_nodes += child.total_nodes
+        if len(self.pruned_by_depth) < len(child.pruned_by_depth):
+            self.pruned_by_depth.extend([0] * (len(child.pruned_by_depth) - len(self.pruned_by_depth)))
+        for d, n in enumerate(child.pruned_by_depth):
+            self.pruned_by_depth[d] += n
+        for k, v in child.tt_stats.items():
+            self.tt_stats[k] += v
+        for k, v in child.cost_tt_stats.items():
+            self.cost_tt_stats[k] += v
+        self.pruned_hand_batch[0] += child.pruned_hand_batch[0]
+        self.pruned_hand_batch[1] += child.pruned_hand_batch[1]
+        self.pruned_drops += child.pruned_drops
+        for tg, child_tg in zip(self.targets, child.targets):
+            tg.pipeline.absorb(child_tg.pipeline)
+        if self.stop_reason is None:
+            self.stop_reason = child.stop_reason
+
+    def stats(self) -> dict:
+        targets = self.targets
+        if len(targets) == 1:
+            prune_stages = targets[0].pipeline.stats()
+        else:
+            prune_stages = [
+                dict(st, name=f"{st['name']}（指定局面{t + 1}）")
+                for t, tg in enumerate(targets)
+                for st in tg.pipeline.stats()
+            ]
+        tt_tiers = sum_tier_stats([tg.unreachable_tt for tg in targets])
+        cost_tt_tiers = sum_tier_stats([tg.cost_tt for tg in targets])
+        return {
+            "total_nodes": self.total_nodes,
+            "pruned_diff_hand_s": sum(tg.stage_hand_s.rejects for tg in targets) + self.pruned_hand_batch[0],
+            "pruned_diff_hand_g": sum(tg.stage_hand_g.rejects for tg in targets) + self.pruned_hand_batch[1],
+            "pruned_need_moves": sum(tg.stage_need_moves.rejects for tg in targets),
+            "pruned_drops": self.pruned_drops,
+            "prune_stages": prune_stages,
+            "prune_stage_reorders": sum(tg.pipeline.reorders for tg in targets),
+            "pruned_by_depth": list(self.pruned_by_depth),
+            "tt_lookups": self.tt_stats["lookups"],
+            "tt_hits": self.tt_stats["hits"],
+            "tt_stores": self.tt_stats["stores"],
+            "tt_store_updates": self.tt_stats["store_updates"],
+            "tt_evictions": tt_tiers["evictions"],
+            "tt_replacement": self.tt_replacement,
+            "tt_size": tt_tiers["l1_size"] + tt_tiers["l2_size"],
+            "tt_max_size": tt_tiers["l1_max_size"] + tt_tiers["l2_slots"],
+            "tt_tiers": tt_tiers,
+            "cost_tt_lookups": self.cost_tt_stats["lookups"],
+            "cost_tt_hits": self.cost_tt_stats["hits"],
+            "cost_tt_size": cost_tt_tiers["l1_size"] + cost_tt_tiers["l2_size"],
+            "cost_tt_max_size": cost_tt_tiers["l1_max_size"] + cost_tt_tiers["l2_slots"],
+            "cost_tt_tiers": cost_tt_tiers,
+            "solution_dag_size": sum(len(tg.solution_dag) for tg in targets),
+            "memory_governor": self.governor.stats() if self.governor else None,
+        }
+
+def restore_cursor(plies: List[dict], board: cs.Board, ply_moves: list, ply_cursor: array,
+                   ply_alive: list, ply_found: list, ply_need: list, path: array) -> int:
+    """
+    再開用ファイルの探索位置（SearchContext.resume_cursor の plies）を探索スタックに戻し、
+    board をその位置まで進めて手数を返す。開始局面（plies[0]）の指し手は ply_moves[0] のまま使い、
+    その先頭の手を読んでいる途中とする。
+    """
+    depth = len(plies) - 1
+    for d, ply in enumerate(plies):
+        if d > 0:
+            legal = {cs.move_to_usi(mv): mv for mv in board.legal_moves}
+            try:
+                ply_moves[d] = [legal[usi] for usi in ply["moves"]]
+            except KeyError as e:
+                raise ValueError(f"再開用ファイルの探索位置に非合法手があります：{e}")
+            ply_cursor[d] = ply["next"]
+        else:
+            ply_cursor[0] = 1 if depth > 0 else 0
+        ply_alive[d] = ply["alive"]
+        ply_found[d] = ply["found"]
+        ply_need[d][:] = array("q", ply["need"])
+        if d < depth:
+            mv = ply_moves[d][ply_cursor[d] - 1]
+            board.push(mv)
+            path[d] = mv
+    return depth
+
 def find_all_paths_to_target(start_board: cs.Board,
-                             target_board: cs.Board,
+                             ctx: SearchContext,
                              max_depth: int,
                              limit: int,
-                             fixed_rfs: set,
-                             tt_memory_mb: int,
-                             margin: int,
                              first_move_index: int,
-                             previous_solutions: List[List[int]],
-                             debug_usis: List[str]):
+                             previous_solutions: List[List[List[int]]],
+                             debug_usis: List[str],
+                             move_ordering: bool = False,
+                             batch_expansion: bool = False,
+                             count_mode: bool = False,
+                             shard: tuple = None,
+                             resume_cursor: dict = None):
+    """
+    start_board から max_depth 手で ctx の各指定局面に至る手順を探索する。
+    1回の探索ですべての指定局面を扱い、子局面はすべての指定局面で枝刈りされたときだけ読まない。
+    previous_solutions と戻り値の解は指定局面ごとのリスト。解数上限 limit も指定局面ごとに適用する
+    （別の呼出で検出済の解数 SearchTarget.found_before も含める）。
+    count_mode のときは解数上限を無視して全解を数え、解の手順は戻り値ではなく
+    SearchTarget.solution_dag に記録する（解を含む部分木は (局面, 残り手数) ごとに1回だけ読む）。
+    Ctrl+C または ctx の探索の上限（SearchContext.set_budget）で中断した場合は interrupted が真になり、
+    上限によるときは ctx.stop_reason に理由が入る。
+    shard = (k, n) のときは、並べた初手のうち k 番目から n 個おきの手だけを読む（複数台での分担用）。
+    first_move_index は分担した初手の中での位置になる。並べた初手すべて（USI）は ctx.root_moves に入る。
+    上限で中断したときは、読んでいる初手の中の探索位置（手数ごとの指し手・次に読む手の位置・
+    探索中の指定局面・解の有無・必要手数）を ctx.resume_cursor に入れる（数え上げモードを除く）。
+    resume_cursor にそれを渡すと、first_move_index 番目の初手の中のその位置から探索を再開する。
+    """
+    targets = ctx.targets
+    fixed_rfs = ctx.fixed_rfs
+    governor = ctx.governor
+    n_targets = len(targets)
+    for tg in targets:
+        adjust_target_turn(start_board, tg.board, max_depth)
+        tg.set_turn(tg.board.turn)
+        validate_piece_counts(start_board, tg.board)
+    interrupted = False
+    total_nodes = 0
+    ctx.resume_cursor = None
+    if len(ctx.pruned_by_depth) < max_depth + 1:
+        ctx.pruned_by_depth.extend([0] * (max_depth + 1 - len(ctx.pruned_by_depth)))
+    pruned_by_depth = ctx.pruned_by_depth
+    pruned_hand_batch = ctx.pruned_hand_batch
+    tt_stats = ctx.tt_stats
+    pruned_drops = 0
+    next_check = SearchContext.CHECK_INTERVAL
+    if count_mode:
+        limit = INF_NEED
 
-    adjust_target_turn(start_board, target_board, max_depth)
-    validate_piece_counts(start_board, target_board)
+    all_mask = (1 << n_targets) - 1
+    done_mask = 0
+    for t, tg in enumerate(targets):
+        tg.solutions = []
+        tg.solution_set = set()
+        for sol in previous_solutions[t]:
+            tg.add_solution(tuple(sol))
+        tg.done = tg.reached_limit(limit)
+        if tg.done:
+            done_mask |= 1 << t
 
-    target_hash = target_board.zobrist_hash()
-    solutions = list(previous_solutions)
-    interrupted = False
- 
-    # 探索スタック (depth, iterator, found_solution)
-    stack = []
+    alive_cache = {}
+
+    def alive_targets(mask):
+        alive = alive_cache.get(mask)
+        if alive is None:
+            alive = [(t, targets[t]) for t in range(n_targets) if mask >> t & 1]
+            alive_cache[mask] = alive
+        return alive
+
+    def count_solutions():
+        if count_mode:
+            return sum(ply_count[0])
+        return sum(len(tg.solutions) for tg in targets)
+
+    # 探索スタック（手数ごとに確保しておく）
+    #   ply_moves[d]：d 手目の局面で読む手のリスト（未展開なら None）
+    #   ply_cursor[d]：次に読む手の位置
+    #   ply_alive[d]：その局面で探索中の指定局面（ビット集合）
+    #   ply_found[d]：解が見つかった指定局面（ビット集合）
+    #   ply_need[d][t]：指定局面 t に対する子局面の必要手数の最小値
+    ply_moves = [None] * (max_depth + 1)
+    ply_cursor = array("l", [0]) * (max_depth + 1)
+    ply_alive = [0] * (max_depth + 1)
+    ply_found = [0] * (max_depth + 1)
+    ply_need = [array("q", [INF_NEED]) * n_targets for _ in range(max_depth + 1)]
+    inf_needs = array("q", [INF_NEED]) * n_targets
+    # 数え上げモード
+    #   ply_count[d][t]：指定局面 t に対する d 手目の局面からの解の数（読み終えた子の分）
+    #   ply_edges[d][t]：解を含む子への辺 (指し手, 子のキー)
+    ply_count = [array("q", [0]) * n_targets for _ in range(max_depth + 1)]
+    ply_edges = [[[] for _ in range(n_targets)] for _ in range(max_depth + 1)]
+    zero_counts = array("q", [0]) * n_targets
+    path = array("L", [0]) * max_depth
     board = start_board
-    path = []
 
-    # 到達不能置換表・コスト計算置換表
-    TT_ENTRY_SIZE = 200        # unreachable TT 1エントリ（bytes）
-    TT_ENTRY_SIZE_COST = 200   # cost TT 1エントリ（bytes）
-    COST_TT_RATIO = 0.4
-    TOTAL_TT_BYTES = tt_memory_mb * 1024 * 1024
-    UNREACHABLE_TT_BYTES = int(TOTAL_TT_BYTES * (1.0 - COST_TT_RATIO))
-    COST_TT_BYTES = TOTAL_TT_BYTES - UNREACHABLE_TT_BYTES
-    TT_MAX_SIZE = UNREACHABLE_TT_BYTES // TT_ENTRY_SIZE
-    COST_TT_MAX_SIZE = COST_TT_BYTES // TT_ENTRY_SIZE_COST
-    unreachable_tt = OrderedDict()
-    cost_tt = OrderedDict()
-
-    # 統計
-    total_nodes = 0
-    pruned_diff_hand_s = 0
-    pruned_diff_hand_g = 0
-    pruned_need_moves = 0
-    pruned_by_depth = [0] * (max_depth + 1)
-    tt_stats = {
-        "lookups": 0,
-        "hits": 0,
-        "stores": 0,
-        "store_updates": 0,
-        "evictions": 0,
-    }
-    cost_tt_stats = {
-        "lookups": 0,
-        "hits": 0,
-    }
+    # 着手前の指し手フィルタ（局面によらないもの）
+    static_filters = [f for f in (fixed_piece_filter(fixed_square_mask(fixed_rfs)),) if f]
+
+    # 指し手の並べ替え（着手後の盤上手数が少ない手から読む）
+    def child_avails(board, remain):
+        remain_child = remain - 1
+        turn_child = 1 - board.turn
+        avail_s = available_moves_for_side(remain_child, turn_child, 0)
+        avail_g = available_moves_for_side(remain_child, turn_child, 1)
+        return avail_s, avail_g
+
+    def move_score(board, mv, avail_s, avail_g, alive):
+        board.push(mv)
+        score = min(sum(tg.need_moves(board, avail_s, avail_g)) for _, tg in alive)
+        board.pop()
+        return score
+
+    # 子ノードの一括展開
+    # 着手で変わるのは手番側の持駒の1枚だけなので、子局面の持駒の差は
+    # 親局面の差と指し手（取った駒・打った駒）から着手前に求められる。
+    def expand(board, depth, remain, alive):
+        """
+        子ノードの指し手を生成して返す。着手前に枝刈りした子の必要手数は ply_need[depth] に反映する。
+        """
+        nonlocal pruned_drops
+        needs = ply_need[depth]
+        moves = apply_move_filters(board.legal_moves, static_filters)
+        avail_s, avail_g = child_avails(board, remain)
+        turn = board.turn
+        other = 1 - turn
+        kinds_list = [tg.relevant_drop_kinds(board, remain) for _, tg in alive]
+        if all(kinds is not None for kinds in kinds_list):
+            n = len(moves)
+            moves = apply_move_filters(moves, [drop_filter(set().union(*kinds_list))])
+            if len(moves) < n:
+                # 除外した子は残り手数以下では到達できない
+                pruned_drops += n - len(moves)
+                pruned_by_depth[depth] += n - len(moves)
+                need = pruned_need(other, remain - 1)
+                for t, _ in alive:
+                    needs[t] = min(needs[t], need)
+        if batch_expansion:
+            hand = board.pieces_in_hand[turn]
+            avail = (avail_s, avail_g)
+            diffs = [(t, tg.hand_diffs(board), tg.board.pieces_in_hand[turn]) for t, tg in alive]
+            survivors = []
+            for mv in moves:
+                drop_k = cs.move_drop_hand_piece(mv) if cs.move_is_drop(mv) else None
+                cap = 0 if drop_k is not None else cs.move_cap(mv)
+                cap_k = piece_to_hand_piece(cap) if cap else None
+                rejected = []
+                for t, diff, target_hand in diffs:
+                    d = diff[turn]
+                    if drop_k is not None:
+                        d += 1 if hand[drop_k] <= target_hand[drop_k] else -1
+                    elif cap_k is not None:
+                        d += 1 if hand[cap_k] >= target_hand[cap_k] else -1
+                    if d <= avail[turn] and diff[other] <= avail[other]:
+                        break
+                    rejected.append((t, d, diff[other]))
+                else:
+                    # すべての指定局面で枝刈り
+                    t, d, d_other = rejected[0]
+                    pruned_hand_batch[turn if d > avail[turn] else other] += 1
+                    pruned_by_depth[depth] += 1
+                    for t, d, d_other in rejected:
+                        if turn == 0:
+                            need = pruned_need(other, remain - 1, d, d_other)
+                        else:
+                            need = pruned_need(other, remain - 1, d_other, d)
+                        needs[t] = min(needs[t], need)
+                    continue
+                survivors.append(mv)
+            moves = survivors
+        if move_ordering:
+            scored = [(move_score(board, mv, avail_s, avail_g, alive), mv) for mv in moves]
+            scored.sort(key=lambda x: x[0])
+            moves = [mv for _, mv in scored]
+        return moves
 
     # DEBUG
     if debug_usis:
@@ -146,164 +750,348 @@ def find_all_paths_to_target(start_board: cs.Board,
         out(f"h_solの長さ：{len(h_sols)}", 0, True)
 
     # 初期状態
-    first_moves_all = sorted(
-        list(board.legal_moves),
-        key=lambda mv: cs.move_to_usi(mv)
-    )
+    # 初手の順序は再開用ファイルの completed_first_moves と対応するため、
+    # 置換表の状態に依存しない値だけで決める。
+    if move_ordering:
+        root_avail_s, root_avail_g = child_avails(board, max_depth)
+        root_alive = alive_targets(all_mask)
+        first_moves_all = sorted(
+            list(board.legal_moves),
+            key=lambda mv: (move_score(board, mv, root_avail_s, root_avail_g, root_alive), cs.move_to_usi(mv))
+        )
+    else:
+        first_moves_all = sorted(
+            list(board.legal_moves),
+            key=lambda mv: cs.move_to_usi(mv)
+        )
+    ctx.root_moves = [cs.move_to_usi(mv) for mv in first_moves_all]
+    if shard is not None:
+        first_moves_all = first_moves_all[shard[0] - 1::shard[1]]
     total_first_moves = len(first_moves_all)
-    first_moves = first_moves_all[first_move_index:]
-    stack.append((0, iter(first_moves), False))
+    root_base = first_move_index
+    root_complete = (first_move_index == 0)
+    # 分担時は開始局面のすべての手を読まないので、開始局面は置換表に登録しない
+    # （解の DAG には分担した初手だけの解の数を登録する）
+    root_store = root_complete and shard is None
+    ply_moves[0] = first_moves_all[first_move_index:]
+    depth = 0
+
+    # 開始局面の TT 判定
+    h = board.zobrist_hash()
+    ply_alive[0] = all_mask & ~done_mask
+    for t, tg in alive_targets(ply_alive[0]):
+        if tt_hit(tg.unreachable_tt, h ^ tg.tt_salt, max_depth, tt_stats):
+            ply_alive[0] &= ~(1 << t)
+    if not ply_alive[0]:
+        first_move_index = total_first_moves
+        depth = -1
+    elif resume_cursor is not None and not count_mode:
+        depth = restore_cursor(resume_cursor["plies"], board, ply_moves, ply_cursor,
+                               ply_alive, ply_found, ply_need, path)
 
     try:
         # 初回進捗表示
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        if total_first_moves > 0:
+        if total_first_moves > 0 and ctx.show_progress:
             percent = int(first_move_index / total_first_moves * 100)
-            out(f"\r[{now}] {percent}% 探索済（検出解数：{len(solutions)}）", 1, True, False, True)
+            out(f"\r[{now}] {percent}% 探索済（検出解数：{count_solutions()}）", 1, True, False, True)
 
-        while stack:
-            depth, it, found_solution = stack[-1]
+        while depth >= 0:
             remain = max_depth - depth
+            alive_mask = ply_alive[depth] & ~done_mask
 
-            # TT 判定
-            h = board.zobrist_hash()
-            if tt_hit(unreachable_tt, h, remain, tt_stats, margin):
-                stack.pop()
-                if path:
-                    board.pop()
-                    path.pop()
-                continue
+            # 子ノードの指し手は TT 判定を通過してから生成する
+            moves = ply_moves[depth]
+            if moves is None:
+                moves = expand(board, depth, remain, alive_targets(alive_mask)) if alive_mask else []
+                ply_moves[depth] = moves
 
-            # 終端
-            if depth == max_depth:
-                if h == target_hash:
-                    new_solution = list(path)
-                    if new_solution not in solutions:
-                        solutions.append(new_solution)
-                    stack[-1] = (depth, it, True)
-                    found_solution = True
-                    if len(solutions) >= limit:
-                        break
-                else:
-                    tt_store(unreachable_tt, h, 0, TT_MAX_SIZE, tt_stats)
-                stack.pop()
-                if path:
+            # すべての手を読み終えた（探索中の指定局面がすべて解数上限に達した場合を含む）
+            c = ply_cursor[depth]
+            if c == len(moves) or not alive_mask:
+                h = board.zobrist_hash()
+                found_mask = ply_found[depth]
+                needs = ply_need[depth]
+                parent_needs = ply_need[depth - 1] if depth > 0 else None
+                for t, tg in alive_targets(ply_alive[depth]):
+                    need = 1 + needs[t]
+                    if not (found_mask | done_mask) >> t & 1 and (depth > 0 or root_store):
+                        tt_store(tg.unreachable_tt, h ^ tg.tt_salt, need, remain, tt_stats)
+                    if h == tg.hash:
+                        need = 0
+                    if parent_needs is not None and need < parent_needs[t]:
+                        parent_needs[t] = need
+                if count_mode and found_mask:
+                    # 解を含む局面を解の DAG に登録し、親局面に解の数と辺を渡す
+                    key = (h, remain)
+                    counts = ply_count[depth]
+                    edges = ply_edges[depth]
+                    for t, tg in alive_targets(found_mask):
+                        if depth > 0 or root_complete:
+                            tg.solution_dag[key] = (counts[t], tuple(edges[t]))
+                        if depth > 0:
+                            ply_count[depth - 1][t] += counts[t]
+                            ply_edges[depth - 1][t].append((path[depth - 1], key))
+                if depth == 0:
+                    first_move_index = root_base + c
+                ply_moves[depth] = None
+                depth -= 1
+                if depth >= 0:
                     board.pop()
-                    path.pop()
-                if stack:
-                    d, it2, f2 = stack[-1]
-                    stack[-1] = (d, it2, f2 or found_solution)
+                    ply_found[depth] |= found_mask
                 continue
 
-            # 次の手
-            try:
-                mv = next(it)
-            except StopIteration:
-                depth, it, found_solution = stack[-1]
-                stack.pop()
-                if depth == 1:
-                    first_move_index += 1
-                if not found_solution:
-                    tt_store(unreachable_tt, h, remain, TT_MAX_SIZE, tt_stats)
-                if path:
-                    board.pop()
-                    path.pop()
-                if stack:
-                    d, it2, f2 = stack[-1]
-                    stack[-1] = (d, it2, f2 or found_solution)
-                continue
+            # 次の手（初手は c 番目より前まで読み終えている）
+            mv = moves[c]
+            ply_cursor[depth] = c + 1
+            if depth == 0:
+                first_move_index = root_base + c
 
-            # 不動駒チェック
-            if is_move_touching_fixed_piece(mv, fixed_rfs):
+            # 指し手フィルタ（不動駒チェックなど）
+            if static_filters and any(f(mv) for f in static_filters):
                 continue
 
             # 着手
             board.push(mv)
-            path.append(mv)
+            path[depth] = mv
             total_nodes += 1
 
-            # 進捗
-            if total_nodes % 100000 == 0:
-                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                if total_first_moves > 0:
-                    percent = int(first_move_index / total_first_moves * 100)
-                    out(f"\r[{now}] {percent}% 探索済（検出解数：{len(solutions)}）", 1, True, False, True)
+            # 探索の上限・メモリ調整・進捗
+            if total_nodes >= next_check:
+                next_check += SearchContext.CHECK_INTERVAL
+                if ctx.budget_exceeded(total_nodes):
+                    raise SearchBudgetExceeded
+                if governor is not None and total_nodes % SearchContext.GOVERNOR_INTERVAL == 0:
+                    governor.sample()
+                if total_nodes % 100000 == 0:
+                    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    if total_first_moves > 0 and ctx.show_progress:
+                        percent = int(first_move_index / total_first_moves * 100)
+                        out(f"\r[{now}] {percent}% 探索済（検出解数：{count_solutions()}）", 1, True, False, True)
+                        if ctx.progress is not None:
+                            ctx.progress({
+                                "nodes": ctx.total_nodes + total_nodes,
+                                "percent": percent,
+                                "solutions": count_solutions(),
+                            })
 
-            remain_child = max_depth - (depth + 1)
+            remain_child = remain - 1
+            h_child = board.zobrist_hash()
+            needs = ply_need[depth]
 
-            # 盤上手数計算
-            avail_s = available_moves_for_side(remain_child, board.turn, 0)
-            avail_g = available_moves_for_side(remain_child, board.turn, 1)
-            h_cost = (board.zobrist_hash(), avail_s, avail_g)
-            cached = cost_tt_get(cost_tt, h_cost, cost_tt_stats)
-            if cached is not None:
-                need_s, need_g = cached
-            else:
-                need_s, need_g = corrected_need_moves_count(board, target_board, avail_s, avail_g, fixed_rfs)
-                cost_tt_store(cost_tt, h_cost, (need_s, need_g), COST_TT_MAX_SIZE)
-            if need_s > avail_s or need_g > avail_g:
-                ### DEBUG ###
-                if len(h_sols) > 0:
-                    for i, h_sol in enumerate(h_sols):
-                        if h == h_sol:
-                            text = KIF.board_to_bod(board)
-                            out(f"手数計算の結果、{i + 1}手目の局面が枝刈りされました。", 1)
-                            out(f"need_s：{need_s}、avail_s：{avail_s}", 1)
-                            out(f"need_g：{need_g}、avail_g：{avail_g}", 1)
-                            out("", 1)
-                            out(text, 1)
-                            out("----------", 1)
-                #############
-                pruned_need_moves += 1
-                pruned_by_depth[depth] += 1
+            # 終端の子は指定局面との一致だけを判定する
+            if remain_child == 0:
                 board.pop()
-                path.pop()
+                for t, tg in alive_targets(alive_mask):
+                    if h_child == tg.hash:
+                        ply_found[depth] |= 1 << t
+                        needs[t] = 0
+                        if count_mode:
+                            ply_count[depth][t] += 1
+                            ply_edges[depth][t].append((mv, None))
+                            continue
+                        sol = tuple(path)
+                        if tg.add_solution(sol) and ctx.on_solution is not None:
+                            ctx.on_solution(sol)
+                        if tg.reached_limit(limit):
+                            tg.done = True
+                            done_mask |= 1 << t
+                    elif needs[t] > 2:
+                        needs[t] = 2
+                if done_mask == all_mask:
+                    break
                 continue
 
-            # 持駒チェック
-            need_hand_s = m_distance_vec(board.pieces_in_hand[0], target_board.pieces_in_hand[0])
-            need_hand_g = m_distance_vec(board.pieces_in_hand[1], target_board.pieces_in_hand[1])
-            if need_hand_s > avail_s:
-                pruned_diff_hand_s += 1
-                pruned_by_depth[depth] += 1
-                board.pop()
-                path.pop()
-                continue
-            if need_hand_g > avail_g:
-                pruned_diff_hand_g += 1
-                pruned_by_depth[depth] += 1
+            # 指定局面ごとに TT 判定（盤上手数計算より先に行う）・盤上手数計算・持駒チェック
+            avail_s = available_moves_for_side(remain_child, board.turn, 0)
+            avail_g = available_moves_for_side(remain_child, board.turn, 1)
+            child_mask = 0
+            pruned = False
+            for t, tg in alive_targets(alive_mask):
+                if count_mode:
+                    # 数え終えた部分木は読まずに解の数を加える
+                    entry = tg.solution_dag.get((h_child, remain_child))
+                    if entry is not None:
+                        ply_found[depth] |= 1 << t
+                        ply_count[depth][t] += entry[0]
+                        ply_edges[depth][t].append((mv, (h_child, remain_child)))
+                        needs[t] = 0
+                        continue
+                entry = tt_hit(tg.unreachable_tt, h_child ^ tg.tt_salt, remain_child, tt_stats)
+                if entry:
+                    need = 0 if h_child == tg.hash else entry[0]
+                    if need < needs[t]:
+                        needs[t] = need
+                    continue
+                stage, need = tg.pipeline.run(board, remain_child, avail_s, avail_g)
+                if stage is not None:
+                    ### DEBUG ###
+                    if len(h_sols) > 0:
+                        for i, h_sol in enumerate(h_sols):
+                            if h_child == h_sol:
+                                text = KIF.board_to_bod(board)
+                                out(f"{stage.name}の結果、{i}手目の局面が枝刈りされました。", 1)
+                                out(f"avail_s：{avail_s}、avail_g：{avail_g}", 1)
+                                out("", 1)
+                                out(text, 1)
+                                out("----------", 1)
+                    #############
+                    pruned = True
+                    if need < needs[t]:
+                        needs[t] = need
+                    continue
+                child_mask |= 1 << t
+            if not child_mask:
+                if pruned:
+                    pruned_by_depth[depth] += 1
                 board.pop()
-                path.pop()
                 continue
 
             # 子ノードへ
-            stack.append((depth + 1, iter(board.legal_moves), False))
+            depth += 1
+            ply_cursor[depth] = 0
+            ply_alive[depth] = child_mask
+            ply_found[depth] = 0
+            ply_need[depth][:] = inf_needs
+            if count_mode:
+                ply_count[depth][:] = zero_counts
+                ply_edges[depth] = [[] for _ in range(n_targets)]
     
         # 最終進捗表示
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        if total_first_moves > 0:
+        if total_first_moves > 0 and ctx.show_progress:
             percent = int(first_move_index / total_first_moves * 100)
-            out(f"\r[{now}] {percent}% 探索済（検出解数：{len(solutions)}）", 1, True, False, True)
+            out(f"\r[{now}] {percent}% 探索済（検出解数：{count_solutions()}）", 1, True, False, True)
+    except SearchBudgetExceeded:
+        interrupted = True
+        if not count_mode:
+            # depth 手目の局面で直前に選んだ手（着手済）はまだ読んでいないので、その手から再開する
+            ctx.resume_cursor = {
+                "plies": [
+                    {
+                        "moves": [cs.move_to_usi(mv) for mv in ply_moves[d]] if d > 0 else [],
+                        "next": ply_cursor[d] if d < depth else ply_cursor[d] - 1,
+                        "alive": ply_alive[d],
+                        "found": ply_found[d],
+                        "need": list(ply_need[d]),
+                    }
+                    for d in range(depth + 1)
+                ]
+            }
     except KeyboardInterrupt:
         interrupted = True
 
-    stats = {
-        "total_nodes": total_nodes,
-        "pruned_diff_hand_s": pruned_diff_hand_s,
-        "pruned_diff_hand_g": pruned_diff_hand_g,
-        "pruned_need_moves": pruned_need_moves,
-        "pruned_by_depth": pruned_by_depth,
-        "tt_lookups": tt_stats["lookups"],
-        "tt_hits": tt_stats["hits"],
-        "tt_stores": tt_stats["stores"],
-        "tt_store_updates": tt_stats["store_updates"],
-        "tt_evictions": tt_stats["evictions"],
-        "tt_size": len(unreachable_tt),
-        "tt_max_size": TT_MAX_SIZE,
-        "cost_tt_lookups": cost_tt_stats["lookups"],
-        "cost_tt_hits": cost_tt_stats["hits"],
-        "cost_tt_size": len(cost_tt),
-        "cost_tt_max_size": COST_TT_MAX_SIZE,
-    }
-
-    return solutions, stats, first_move_index, interrupted
+    ctx.total_nodes += total_nodes
+    ctx.pruned_drops += pruned_drops
+    stats = ctx.stats()
+
+    return [tg.solutions for tg in targets], stats, first_move_index, interrupted
+
+def find_all_paths_parallel(start_board: cs.Board,
+                            ctx: SearchContext,
+                            max_depth: int,
+                            limit: int,
+                            first_move_index: int,
+                            previous_solutions: List[List[List[int]]],
+                            debug_usis: List[str],
+                            move_ordering: bool = False,
+                            batch_expansion: bool = False,
+                            count_mode: bool = False):
+    """
+    find_all_paths_to_target を ctx.threads 個のスレッドで並列に行う（GIL のない Python 用）。
+    並べた初手をスレッド数で分担し（shard）、スレッドごとに盤面と探索状態（SearchContext.fork）を持ち、置換表は共有する。
+    解は並べた初手の順に並べ直してから指定局面ごとに解数上限を適用するので、1スレッドの探索と同じ解を返す。
+    first_move_index と戻り値の読み終えた初手の数は、並べた初手すべての中での位置
+    （戻り値はすべてのスレッドが読み終えた範囲）。
+    """
+    for tg in ctx.targets:
+        adjust_target_turn(start_board, tg.board, max_depth)
+        tg.set_turn(tg.board.turn)
+    n_threads = ctx.threads
+    children = [ctx.fork() for _ in range(n_threads)]
+    root = (start_board.zobrist_hash(), max_depth)
+    if count_mode:
+        # 数え終えた部分木は各スレッドで使い回す（開始局面の解の数は各スレッドの初手の分だけを数える）
+        for child in children:
+            for tg, child_tg in zip(ctx.targets, child.targets):
+                child_tg.solution_dag = dict(tg.solution_dag)
+                child_tg.solution_dag.pop(root, None)
+    halt = threading.Event()
+    results = [None] * n_threads
+    errors = []
+
+    def run(w):
+        child = children[w]
+        child.halt = halt
+        child.show_progress = (w == 0)
+        if w > 0:
+            child.progress = None
+        # 再開時は並べた初手の first_move_index 番目から読む（スレッド w の初手は w, w + n, w + 2n, ...）
+        start = max(0, -(-(first_move_index - w) // n_threads))
+        try:
+            results[w] = find_all_paths_to_target(
+                start_board.copy(), child, max_depth, limit, start, previous_solutions, debug_usis,
+                move_ordering, batch_expansion, count_mode, (w + 1, n_threads)
+            )
+        except Exception as e:
+            errors.append(e)
+        if results[w] is None or results[w][3]:
+            halt.set()
+
+    workers = [threading.Thread(target=run, args=(w,)) for w in range(n_threads)]
+    for t in workers:
+        t.start()
+    interrupted = False
+    try:
+        for t in workers:
+            while t.is_alive():
+                t.join(0.1)
+    except KeyboardInterrupt:
+        halt.set()
+        interrupted = True
+        for t in workers:
+            t.join()
+    if errors:
+        raise errors[0]
+
+    for child in children:
+        ctx.absorb(child)
+    ctx.root_moves = children[0].root_moves
+    order = {usi: j for j, usi in enumerate(ctx.root_moves)}
+    interrupted = interrupted or any(r[3] for r in results)
+    total_first_moves = len(ctx.root_moves)
+    completed_first_moves = min(min(w + r[2] * n_threads for w, r in enumerate(results)), total_first_moves)
+
+    for t, tg in enumerate(ctx.targets):
+        child_tgs = [child.targets[t] for child in children]
+        if count_mode:
+            # 部分木の解の数はどのスレッドが数えても同じなので合わせ、開始局面は各スレッドの初手の分を合計する
+            roots = [child_tg.solution_dag.pop(root) for child_tg in child_tgs if root in child_tg.solution_dag]
+            for child_tg in child_tgs:
+                tg.solution_dag.update(child_tg.solution_dag)
+            if roots:
+                edges = sorted((e for _, es in roots for e in es), key=lambda e: order[cs.move_to_usi(e[0])])
+                tg.solution_dag[root] = (sum(n for n, _ in roots), tuple(edges))
+            continue
+        # 検出済の解の後に、各スレッドの新しい解を初手の順（同じ初手の中では探索順）に並べる
+        tg.solutions = []
+        tg.solution_set = set()
+        for sol in previous_solutions[t]:
+            tg.add_solution(tuple(sol))
+        found = sorted(
+            (
+                (order[cs.move_to_usi(sol[0])], j, sol)
+                for child_tg in child_tgs
+                for j, sol in enumerate(child_tg.solutions)
+                if tuple(sol) not in tg.solution_set
+            ),
+            key=lambda x: x[:2]
+        )
+        for _, _, sol in found:
+            if tg.reached_limit(limit):
+                break
+            if tg.add_solution(tuple(sol)) and ctx.on_solution is not None:
+                ctx.on_solution(tuple(sol))
+        tg.done = tg.reached_limit(limit)
+
+    return [tg.solutions for tg in ctx.targets], ctx.stats(), completed_first_moves, interrupted
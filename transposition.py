@@ -0,0 +1,696 @@
+# Structa - Shogi Proof Game Proofer
+# Copyright (C) 2026 Masataka Izumi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import psutil
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, List, Optional
+from io_utils import out
+
+MASK64 = (1 << 64) - 1
+
+L1_ENTRY_SIZE = 200   # L1 1エントリ（bytes）
+L2_ENTRY_SIZE = 16    # L2 1スロット（キー8 + 値8 bytes）
+DISK_BUCKET_SLOTS = 4                                 # ディスク層の1バケットのスロット数
+DISK_BUCKET_SIZE = DISK_BUCKET_SLOTS * L2_ENTRY_SIZE  # 64 bytes
+DISK_BATCH_SIZE = 4096                                # ディスク層にまとめて書き込むエントリ数
+BLOOM_BITS_PER_SLOT = 8                               # ディスク層のブルームフィルタのビット数（1スロットあたり）
+L1_RATIO = 0.125      # 置換表のメモリのうち L1 に割り当てる割合
+
+# L2 の置換方式
+#   lru      : 新しいエントリを先頭に入れ、古い方（2番目）を追い出す
+#   depth    : 深さの小さい方を追い出す。新しいエントリの方が浅ければ新しいエントリを捨てる
+#   two_slot : 先頭は深さ優先、2番目は常に置換。深さが先頭以上なら先頭を2番目に移して先頭に入れる
+#   band     : 深さの帯ごとに別の2ウェイ表を持ち、帯の中は lru で置換する（参照時は全帯を調べる）
+# 深さは depth(packed) で求める（到達不能置換表では到達できないと確定した残り手数）
+REPLACEMENT_POLICIES = ("lru", "depth", "two_slot", "band")
+N_BANDS = 4
+BAND_OF_DEPTH = (0, 0, 1, 1, 2, 2, 2, 3)   # 残り手数 0-1, 2-3, 4-6, 7 以上
+
+class DiskTier:
+    """
+    L2 から追い出したエントリを格納するディスク上のハッシュ表（L3）。
+    ファイルは DISK_BUCKET_SLOTS スロットのバケットの並びで、1スロットは L2 と同じくキー8 + 値8 bytes。
+    追い出したエントリは pending に溜め、DISK_BATCH_SIZE 件ごとにバケット順に並べてまとめて書き込む。
+    参照はメモリ上のブルームフィルタで「ない」と分かるものを除いてから行う（削除はしないので、
+    上書きで消えたエントリは偽陽性になるだけ）。
+    バケットが埋まっていれば新しいエントリを先頭に入れ、最も古いエントリを捨てる。
+    同じキーがあれば merge(既存の値, 新しい値) で合わせる（なければ新しい値で上書きする）。
+    ファイルは一時ファイルとして directory（空ならシステムの一時ディレクトリ）に作り、終了時に削除される。
+    """
+    def __init__(self, disk_bytes: int, directory: str = "", merge: Optional[Callable] = None):
+        n_buckets = max(1, disk_bytes // DISK_BUCKET_SIZE)
+        self.n_buckets = 1 << (n_buckets.bit_length() - 1)
+        n_bits = max(8, self.n_buckets * DISK_BUCKET_SLOTS * BLOOM_BITS_PER_SLOT)
+        self.bloom_mask = (1 << (n_bits.bit_length() - 1)) - 1
+        self.bloom = bytearray((self.bloom_mask >> 3) + 1)
+        self.file = tempfile.TemporaryFile(dir=directory or None, buffering=0)
+        self.file.truncate(self.n_buckets * DISK_BUCKET_SIZE)
+        self.pending = {}
+        self.merge = merge
+        # 統計
+        self.size = 0
+        self.writes = 0
+        self.flushes = 0
+        self.probes = 0
+        self.hits = 0
+        self.filtered = 0
+        self.evictions = 0
+
+    def bloom_bits(self, key: int) -> tuple:
+        mask = self.bloom_mask
+        return key & mask, (key >> 32 | key << 32) & mask
+
+    def add(self, key: int, packed: int):
+        bloom = self.bloom
+        for b in self.bloom_bits(key):
+            bloom[b >> 3] |= 1 << (b & 7)
+        prev = self.pending.get(key)
+        if prev is not None and self.merge is not None:
+            packed = self.merge(prev, packed)
+        self.pending[key] = packed
+        if len(self.pending) >= DISK_BATCH_SIZE:
+            self.flush()
+
+    def read_bucket(self, b: int) -> array:
+        self.file.seek(b * DISK_BUCKET_SIZE)
+        bucket = array("Q")
+        bucket.frombytes(self.file.read(DISK_BUCKET_SIZE))
+        return bucket
+
+    def flush(self):
+        """
+        pending のエントリをバケット順に書き込む（バケットごとに1回の読み込みと書き込み）。
+        値は符号なしの64ビットとして読み書きする（詰めた値は負にならない）。
+        """
+        if not self.pending:
+            return
+        self.flushes += 1
+        mask = self.n_buckets - 1
+        items = sorted(self.pending.items(), key=lambda kv: kv[0] & mask)
+        self.pending = {}
+        f = self.file
+        n = len(items)
+        i = 0
+        while i < n:
+            b = items[i][0] & mask
+            bucket = self.read_bucket(b)
+            while i < n and items[i][0] & mask == b:
+                key, packed = items[i]
+                i += 1
+                self.writes += 1
+                keys = bucket[0::2]
+                if key in keys:
+                    j = keys.index(key) * 2 + 1
+                    bucket[j] = self.merge(bucket[j], packed) if self.merge is not None else packed
+                    continue
+                if keys[-1]:
+                    self.evictions += 1
+                else:
+                    self.size += 1
+                bucket[2:] = bucket[:-2]
+                bucket[0] = key
+                bucket[1] = packed
+            f.seek(b * DISK_BUCKET_SIZE)
+            f.write(bucket.tobytes())
+
+    def get(self, key: int) -> Optional[int]:
+        bloom = self.bloom
+        for b in self.bloom_bits(key):
+            if not bloom[b >> 3] >> (b & 7) & 1:
+                self.filtered += 1
+                return None
+        packed = self.pending.get(key)
+        if packed is not None:
+            self.hits += 1
+            return packed
+        self.probes += 1
+        bucket = self.read_bucket(key & (self.n_buckets - 1))
+        keys = bucket[0::2]
+        if key in keys:
+            self.hits += 1
+            return bucket[keys.index(key) * 2 + 1]
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "disk_size": self.size,
+            "disk_slots": self.n_buckets * DISK_BUCKET_SLOTS,
+            "disk_writes": self.writes,
+            "disk_flushes": self.flushes,
+            "disk_probes": self.probes,
+            "disk_hits": self.hits,
+            "disk_filtered": self.filtered,
+            "disk_evictions": self.evictions,
+            "bloom_bytes": len(self.bloom),
+        }
+
+class TwoTierTable:
+    """
+    2層の置換表。
+        L1 : 直近に使ったエントリを持つ小さな LRU（OrderedDict）。ヒット時の処理は従来の置換表と同じ
+        L2 : 大きな2ウェイのハッシュ表（array、1スロット16 bytes）。L1 から追い出したエントリを格納する
+    L2 でヒットしたエントリは L1 に昇格し、L1 から追い出したエントリは L2 に降格する。
+    L2 のキーは64ビットの整数、値は pack / unpack で64ビットの整数と相互に変換する。
+    L2 の配列は最初に降格が起きたときに確保する。
+    L2 の置換方式は policy（REPLACEMENT_POLICIES のいずれか）で選ぶ。lru 以外は depth が必要。
+    spill（DiskTier）を与えると、L2 から追い出したエントリをディスクに格納し、L2 にないときに参照する。
+    band のバケットは (キーの下位ビット) * N_BANDS + 帯 の順に並べ、1つのキーの全帯が連続する。
+    """
+    def __init__(self, memory_bytes: int, pack: Callable, unpack: Callable,
+                 depth: Optional[Callable] = None, policy: str = "lru",
+                 spill: Optional[DiskTier] = None):
+        if policy not in REPLACEMENT_POLICIES:
+            raise ValueError(f"置換方式 {policy} は使用できません（{'、'.join(REPLACEMENT_POLICIES)}）。")
+        if policy != "lru" and depth is None:
+            raise ValueError(f"置換方式 {policy} には深さが必要です。")
+        self.l1 = OrderedDict()
+        self.l1_max_size = max(1, int(memory_bytes * L1_RATIO) // L1_ENTRY_SIZE)
+        n_buckets = max(1, (memory_bytes - self.l1_max_size * L1_ENTRY_SIZE) // (2 * L2_ENTRY_SIZE))
+        self.l2_buckets = 1 << (n_buckets.bit_length() - 1)   # 2のべき乗に切り下げる
+        if policy == "band":
+            self.l2_buckets = max(self.l2_buckets, N_BANDS)
+        self.l2_keys = None
+        self.l2_vals = None
+        self.l2_size = 0
+        self.pack = pack
+        self.unpack = unpack
+        self.depth = depth
+        self.policy = policy
+        self.spill = spill
+        self.replace = {
+            "lru": self.replace_lru,
+            "depth": self.replace_depth,
+            "two_slot": self.replace_two_slot,
+            "band": self.replace_lru,
+        }[policy]
+        # 統計
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.demotions = 0
+        self.evictions = 0
+        self.evicted_depth_sum = 0   # 追い出した（または捨てた）エントリの深さの合計
+
+    def __len__(self) -> int:
+        return len(self.l1) + self.l2_size
+
+    def reset_stats(self):
+        """
+        統計だけを初期化する（置換表を別の探索で使い回すとき）。
+        """
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.demotions = 0
+        self.evictions = 0
+        self.evicted_depth_sum = 0
+
+    def l2_slots(self) -> int:
+        return self.l2_buckets * 2
+
+    def l2_bytes(self) -> int:
+        """
+        L2 の大きさ（bytes）。未確保でも確保したときの大きさを返す。
+        """
+        return self.l2_slots() * L2_ENTRY_SIZE
+
+    def set_l1_max_size(self, n: int):
+        """
+        L1 の登録数上限を変更する。あふれたエントリは L2 に降格する。
+        """
+        self.l1_max_size = max(1, n)
+        l1 = self.l1
+        while len(l1) > self.l1_max_size:
+            self.demote(*l1.popitem(last=False))
+
+    def resize_l2(self, n_buckets: int):
+        """
+        L2 のバケット数を変更する（2のべき乗、1回に2倍または1/2）。
+        2倍にするときは配列を2つ並べる（キーが一致しないコピーは参照されず、いずれ上書きされる）。
+        1/2にするときは、統合する2つのバケットの4つのエントリのうち2つを残し、残りは追い出す。
+        lru ではそれぞれのバケットの新しい方を残し、それ以外の置換方式では深さの大きい2つを深い順に残す
+        （two_slot では深さ優先の枠のエントリ、band では同じ帯のエントリの中で深いものになる）。
+        """
+        old = self.l2_buckets
+        if self.policy == "band" and n_buckets < N_BANDS:
+            return
+        self.l2_buckets = n_buckets
+        if self.l2_keys is None:
+            return
+        if n_buckets == old * 2:
+            self.l2_keys = self.l2_keys + self.l2_keys
+            self.l2_vals = self.l2_vals + self.l2_vals
+        elif n_buckets * 2 == old and self.policy == "lru":
+            keys = array("Q", [0]) * (n_buckets * 2)
+            vals = array("q", [0]) * (n_buckets * 2)
+            keys[0::2] = self.l2_keys[0:old:2]
+            keys[1::2] = self.l2_keys[old::2]
+            vals[0::2] = self.l2_vals[0:old:2]
+            vals[1::2] = self.l2_vals[old::2]
+            for key, packed in zip(self.l2_keys[1::2], self.l2_vals[1::2]):
+                if key:
+                    self.evict(key, packed)
+            self.l2_keys = keys
+            self.l2_vals = vals
+        elif n_buckets * 2 == old:
+            # 新しいバケット j には元のバケット j と j + n_buckets が入る（スロットは i, i + 1, i + old, i + old + 1）
+            old_keys = self.l2_keys
+            old_vals = self.l2_vals
+            keys = array("Q", [0]) * (n_buckets * 2)
+            vals = array("q", [0]) * (n_buckets * 2)
+            depth = self.depth
+            for i in range(0, old, 2):
+                entries = [(old_keys[j], old_vals[j]) for j in (i, i + 1, i + old, i + old + 1) if old_keys[j]]
+                entries.sort(key=lambda e: depth(e[1]), reverse=True)
+                for k, (key, packed) in enumerate(entries):
+                    if k < 2:
+                        keys[i + k] = key
+                        vals[i + k] = packed
+                    else:
+                        self.evict(key, packed)
+            self.l2_keys = keys
+            self.l2_vals = vals
+        else:
+            raise ValueError(f"L2 のバケット数は2倍または1/2にのみ変更できます：{old} -> {n_buckets}")
+        self.l2_size = len(self.l2_keys) - self.l2_keys.count(0)   # 2倍にした直後はコピーを含む概数
+
+    def l2_index(self, key: int) -> int:
+        """
+        L2 でキーのあるスロットの位置。なければ -1。
+        """
+        if self.l2_keys is None:
+            return -1
+        keys = self.l2_keys
+        if self.policy == "band":
+            i = (key & ((self.l2_buckets >> 2) - 1)) << 3
+            seg = keys[i:i + 2 * N_BANDS]
+            return i + seg.index(key) if key in seg else -1
+        i = (key & (self.l2_buckets - 1)) << 1
+        return i if keys[i] == key else i + 1 if keys[i + 1] == key else -1
+
+    def get(self, key: int):
+        v = self.l1.get(key)
+        if v is not None:
+            self.l1_hits += 1
+            self.l1.move_to_end(key)
+            return v
+        if self.l2_keys is not None:
+            j = self.l2_index(key)
+            if j >= 0:
+                self.l2_hits += 1
+                v = self.unpack(self.l2_vals[j])
+                self.promotions += 1
+                self.put(key, v)
+                return v
+        if self.spill is not None:
+            packed = self.spill.get(key)
+            if packed is not None:
+                v = self.unpack(packed)
+                self.promotions += 1
+                self.put(key, v)
+                return v
+        self.misses += 1
+        return None
+
+    def peek(self, key: int):
+        """
+        L1 と L2 だけを参照する（ディスクは読まず、統計・LRU の順・昇格も変えない）。登録の前の確認用。
+        """
+        v = self.l1.get(key)
+        if v is not None:
+            return v
+        j = self.l2_index(key)
+        return self.unpack(self.l2_vals[j]) if j >= 0 else None
+
+    def put(self, key: int, v):
+        l1 = self.l1
+        l1[key] = v
+        l1.move_to_end(key)
+        if len(l1) > self.l1_max_size:
+            self.demote(*l1.popitem(last=False))
+
+    def demote(self, key: int, v):
+        """
+        L1 から追い出したエントリを L2 のバケットに格納する。
+        同じキーがあれば値を更新し、空きスロットがあればそこに入れる。
+        バケットが埋まっていれば置換方式に従って追い出すエントリを決める。
+        """
+        if self.l2_keys is None:
+            self.l2_keys = array("Q", [0]) * self.l2_slots()
+            self.l2_vals = array("q", [0]) * self.l2_slots()
+        self.demotions += 1
+        keys = self.l2_keys
+        vals = self.l2_vals
+        packed = self.pack(v)
+        if self.policy == "band":
+            band = BAND_OF_DEPTH[min(self.depth(packed), 7)]
+            i = ((key & ((self.l2_buckets >> 2) - 1)) << 2 | band) << 1
+        else:
+            i = (key & (self.l2_buckets - 1)) << 1
+        if keys[i] == key:
+            vals[i] = packed
+            return
+        if keys[i + 1] == key:
+            vals[i + 1] = packed
+            return
+        if not keys[i]:
+            self.l2_size += 1
+            keys[i] = key
+            vals[i] = packed
+            return
+        self.replace(keys, vals, i, key, packed)
+
+    def evict(self, key: int, packed: int):
+        self.evictions += 1
+        if self.depth is not None:
+            self.evicted_depth_sum += self.depth(packed)
+        if self.spill is not None:
+            self.spill.add(key, packed)
+
+    def replace_lru(self, keys: array, vals: array, i: int, key: int, packed: int):
+        if keys[i + 1]:
+            self.evict(keys[i + 1], vals[i + 1])
+        else:
+            self.l2_size += 1
+        keys[i + 1], vals[i + 1] = keys[i], vals[i]
+        keys[i] = key
+        vals[i] = packed
+
+    def replace_depth(self, keys: array, vals: array, i: int, key: int, packed: int):
+        if not keys[i + 1]:
+            self.l2_size += 1
+            keys[i + 1] = key
+            vals[i + 1] = packed
+            return
+        depth = self.depth
+        j = i if depth(vals[i]) < depth(vals[i + 1]) else i + 1
+        if depth(packed) < depth(vals[j]):
+            self.evict(key, packed)
+            return
+        self.evict(keys[j], vals[j])
+        keys[j] = key
+        vals[j] = packed
+
+    def replace_two_slot(self, keys: array, vals: array, i: int, key: int, packed: int):
+        if keys[i + 1]:
+            self.evict(keys[i + 1], vals[i + 1])
+        else:
+            self.l2_size += 1
+        if self.depth(packed) >= self.depth(vals[i]):
+            keys[i + 1], vals[i + 1] = keys[i], vals[i]
+            keys[i] = key
+            vals[i] = packed
+        else:
+            keys[i + 1] = key
+            vals[i + 1] = packed
+
+    def stats(self) -> dict:
+        spill_stats = self.spill.stats() if self.spill is not None else {}
+        return {
+            **spill_stats,
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "promotions": self.promotions,
+            "demotions": self.demotions,
+            "evictions": self.evictions,
+            "evicted_depth_sum": self.evicted_depth_sum,
+            "l1_size": len(self.l1),
+            "l1_max_size": self.l1_max_size,
+            "l2_size": self.l2_size,
+            "l2_slots": self.l2_slots(),
+        }
+
+class StripedTable:
+    """
+    複数のスレッドで共有する置換表（GIL のない Python での並列探索用）。
+    キーの上位ビットで2のべき乗個の TwoTierTable（ストライプ）に分け、ストライプごとのロックで守る。
+    tt_store の peek と put の間に他のスレッドが同じキーを更新することがあるが、
+    どちらの値も証明済みの下界（コスト計算置換表では同じ値）なので、どちらが残っても探索結果は変わらない。
+    """
+    def __init__(self, tables: List[TwoTierTable]):
+        self.tables = tables
+        self.locks = [threading.Lock() for _ in tables]
+        self.shift = 64 - (len(tables).bit_length() - 1)
+
+    def __len__(self) -> int:
+        return sum(len(t) for t in self.tables)
+
+    def reset_stats(self):
+        for t in self.tables:
+            t.reset_stats()
+
+    def get(self, key: int):
+        i = key >> self.shift
+        with self.locks[i]:
+            return self.tables[i].get(key)
+
+    def peek(self, key: int):
+        i = key >> self.shift
+        with self.locks[i]:
+            return self.tables[i].peek(key)
+
+    def put(self, key: int, v):
+        i = key >> self.shift
+        with self.locks[i]:
+            self.tables[i].put(key, v)
+
+    def stats(self) -> dict:
+        total = {}
+        for t in self.tables:
+            for k, v in t.stats().items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+def new_table(memory_bytes: int, stripes: int, make: Callable):
+    """
+    make(ストライプの大きさ) で作った置換表を返す。stripes が 2 以上なら StripedTable にする。
+    """
+    if stripes <= 1:
+        return make(memory_bytes)
+    return StripedTable([make(memory_bytes // stripes) for _ in range(stripes)])
+
+####################
+# 到達不能置換表
+####################
+# 到達不能置換表には (need, failed_remain) を記録する。
+#   need：その局面から 1 手以上指して指定局面に到達するのに必要な手数の下界
+#   failed_remain：到達できないと確定した残り手数
+# 残り手数 remain が need 未満か failed_remain と一致すれば到達できない。
+# 値 (need, failed_remain) を need << 8 | failed_remain に詰める（残り手数は 255 以下）
+def pack_unreachable(v) -> int:
+    return v[0] << 8 | v[1]
+
+def unpack_unreachable(x: int) -> tuple:
+    return (x >> 8, x & 0xFF)
+
+def unreachable_depth(x: int) -> int:
+    """
+    詰めた値の深さ（到達できないと確定した残り手数）。大きいほど確定に多くの探索を要している。
+    """
+    return x & 0xFF
+
+def merge_unreachable(x: int, y: int) -> int:
+    """
+    同じ局面の詰めた値を合わせる（need と failed_remain のそれぞれ大きい方。どちらも証明済みの値）。
+    """
+    return max(x >> 8, y >> 8) << 8 | max(x & 0xFF, y & 0xFF)
+
+def new_unreachable_tt(memory_bytes: int, policy: str = "lru",
+                       disk_bytes: int = 0, disk_dir: str = "", stripes: int = 1):
+    def make(size):
+        spill = DiskTier(disk_bytes // max(stripes, 1), disk_dir, merge_unreachable) if disk_bytes > 0 else None
+        return TwoTierTable(size, pack_unreachable, unpack_unreachable, unreachable_depth, policy, spill)
+    return new_table(memory_bytes, stripes, make)
+
+def tt_hit(tt: TwoTierTable, h: int, remain: int, stats: dict) -> Optional[tuple]:
+    """
+    残り手数 remain の局面 h が到達不能と確定していればエントリ (need, failed_remain) を返す。
+    """
+    stats["lookups"] += 1
+    entry = tt.get(h)
+    if entry is None:
+        return None
+    need, failed_remain = entry
+    if remain < need or remain == failed_remain:
+        stats["hits"] += 1
+        return entry
+    return None
+
+def tt_store(tt: TwoTierTable, h: int, need: int, remain: int, stats: dict):
+    # ディスクの層は見ない。ディスクにより強い値があっても、追い出すときに DiskTier が値を合わせる
+    prev = tt.peek(h)
+    if prev is None:
+        tt.put(h, (need, remain))
+        stats["stores"] += 1
+    elif need > prev[0] or remain > prev[1]:
+        tt.put(h, (max(need, prev[0]), max(remain, prev[1])))
+        stats["store_updates"] += 1
+
+####################
+# コスト計算置換表
+####################
+# 値 (need_s, need_g) を need_s << 32 | need_g に詰める
+def pack_cost(v) -> int:
+    return v[0] << 32 | v[1]
+
+def unpack_cost(x: int) -> tuple:
+    return (x >> 32, x & 0xFFFFFFFF)
+
+def new_cost_tt(memory_bytes: int, stripes: int = 1):
+    return new_table(memory_bytes, stripes, lambda size: TwoTierTable(size, pack_cost, unpack_cost))
+
+def cost_tt_key(h: int, avail_s: int, avail_g: int) -> int:
+    """
+    局面のハッシュと先手・後手の残り手数から64ビットのキーを作る。
+    """
+    return h ^ ((avail_s << 8 | avail_g) * 0x9E3779B97F4A7C15 & MASK64)
+
+def cost_tt_get(cost_tt: TwoTierTable, key: int, stats: dict):
+    stats["lookups"] += 1
+    v = cost_tt.get(key)
+    if v is not None:
+        stats["hits"] += 1
+    return v
+
+def cost_tt_store(cost_tt: TwoTierTable, key: int, v):
+    cost_tt.put(key, v)
+
+####################
+# メモリ調整
+####################
+class MemoryGovernor:
+    """
+    psutil で RSS と空きメモリを計測し、置換表が実際に使うメモリを budget_bytes に近づける。
+        ・L1 1エントリあたりの実測の大きさから L1 の登録数上限を決める（L2 は確保時の大きさで数える）
+        ・空きメモリが reserve_bytes を下回ったら置換表を縮小する（L1 で足りなければ L2 を半分にする）
+        ・L1 が満杯で、直近の L2 でのヒット率（L1 を大きくすれば L1 で見つかったはずの割合）が
+          高い方の置換表に L1 を多く割り当てる
+    RSS は dict の削除ですぐには減らないので、実測は L1 の合計が最大を更新したときだけ行う。
+    """
+    MIN_RATIO = 0.1
+    MAX_RATIO = 0.9
+    RATIO_STEP = 0.05
+    RATE_MARGIN = 0.01
+    MIN_LOOKUPS = 1000   # ヒット率を比べるのに必要な参照回数
+
+    def __init__(self, tt_tables: List[TwoTierTable], cost_tables: List[TwoTierTable],
+                 budget_bytes: int, cost_ratio: float):
+        self.process = psutil.Process()
+        self.base_rss = self.process.memory_info().rss
+        self.max_rss = self.base_rss
+        self.tt_tables = tt_tables
+        self.cost_tables = cost_tables
+        self.budget = budget_bytes
+        total = psutil.virtual_memory().total
+        self.reserve_bytes = min(512 * 1024 * 1024, total // 10)
+        self.cost_ratio = cost_ratio
+        self.bytes_per_entry = float(L1_ENTRY_SIZE)
+        self.l1_peak = 0
+        self.samples = 0
+        self.adjustments = 0
+        self.last_counts = (0, 0, 0, 0)
+
+    @staticmethod
+    def l2_hit_counts(tables: List[TwoTierTable]) -> tuple:
+        l2_hits = sum(t.l2_hits for t in tables)
+        return l2_hits, sum(t.l1_hits + t.l2_hits + t.misses for t in tables)
+
+    @staticmethod
+    def l1_full(tables: List[TwoTierTable]) -> bool:
+        return any(len(t.l1) >= t.l1_max_size for t in tables)
+
+    def sample(self):
+        self.samples += 1
+        rss = self.process.memory_info().rss
+        avail = psutil.virtual_memory().available
+        self.max_rss = max(self.max_rss, rss)
+        used = rss - self.base_rss
+        tables = self.tt_tables + self.cost_tables
+        l2_bytes = sum(t.l2_bytes() for t in tables)
+        allocated_l2 = sum(t.l2_bytes() for t in tables if t.l2_keys is not None)
+        l1_entries = sum(len(t.l1) for t in tables)
+
+        # L1 1エントリあたりの大きさの実測
+        if l1_entries > self.l1_peak and l1_entries >= 10000:
+            self.l1_peak = l1_entries
+            measured = (used - allocated_l2) / l1_entries
+            if measured > 0:
+                self.bytes_per_entry = max(64.0, (self.bytes_per_entry + measured) / 2)
+
+        # 空きメモリが少なければ目標を下げる
+        budget = self.budget
+        if avail < self.reserve_bytes:
+            budget = min(budget, max(used - (self.reserve_bytes - avail), self.budget // 16))
+
+        # L2 でのヒット率に応じて L1 の配分を変える
+        tt_l2_hits, tt_gets = self.l2_hit_counts(self.tt_tables)
+        cost_l2_hits, cost_gets = self.l2_hit_counts(self.cost_tables)
+        d_tt_l2_hits = tt_l2_hits - self.last_counts[0]
+        d_tt_gets = tt_gets - self.last_counts[1]
+        d_cost_l2_hits = cost_l2_hits - self.last_counts[2]
+        d_cost_gets = cost_gets - self.last_counts[3]
+        self.last_counts = (tt_l2_hits, tt_gets, cost_l2_hits, cost_gets)
+        ratio = self.cost_ratio
+        if d_tt_gets >= self.MIN_LOOKUPS and d_cost_gets >= self.MIN_LOOKUPS:
+            tt_rate = d_tt_l2_hits / d_tt_gets
+            cost_rate = d_cost_l2_hits / d_cost_gets
+            if cost_rate > tt_rate + self.RATE_MARGIN and self.l1_full(self.cost_tables):
+                ratio = min(self.MAX_RATIO, ratio + self.RATIO_STEP)
+            elif tt_rate > cost_rate + self.RATE_MARGIN and self.l1_full(self.tt_tables):
+                ratio = max(self.MIN_RATIO, ratio - self.RATIO_STEP)
+
+        # L1 で足りなければ最も大きい L2 を半分にする
+        if budget - l2_bytes < budget // 16:
+            largest = max(tables, key=lambda t: t.l2_buckets)
+            if largest.l2_buckets > 1:
+                largest.resize_l2(largest.l2_buckets // 2)
+                l2_bytes = sum(t.l2_bytes() for t in tables)
+                self.adjustments += 1
+                out(f"置換表調整：空きメモリ {avail // 2**20:,} MB、L2 を {largest.l2_slots():,} スロットに縮小", 2)
+
+        # L1 の登録数上限
+        l1_total = int(max(budget - l2_bytes, budget // 16) / self.bytes_per_entry)
+        tt_size = max(1, int(l1_total * (1.0 - ratio)) // len(self.tt_tables))
+        cost_size = max(1, int(l1_total * ratio) // len(self.cost_tables))
+        old_tt_size = self.tt_tables[0].l1_max_size
+        old_cost_size = self.cost_tables[0].l1_max_size
+        if abs(tt_size - old_tt_size) > old_tt_size // 10 or abs(cost_size - old_cost_size) > old_cost_size // 10:
+            for t in self.tt_tables:
+                t.set_l1_max_size(tt_size)
+            for t in self.cost_tables:
+                t.set_l1_max_size(cost_size)
+            self.adjustments += 1
+            out(
+                f"置換表調整：RSS {rss // 2**20:,} MB（増分 {used // 2**20:,} MB）、空きメモリ {avail // 2**20:,} MB、"
+                f"L1 1件 {self.bytes_per_entry:.0f} bytes、コスト計算 TT の比率 {ratio:.2f}、"
+                f"L1 上限 到達不能 {tt_size:,} / コスト計算 {cost_size:,}",
+                2
+            )
+        self.cost_ratio = ratio
+
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "adjustments": self.adjustments,
+            "max_rss": self.max_rss,
+            "bytes_per_entry": self.bytes_per_entry,
+            "cost_ratio": self.cost_ratio,
+        }
@@ -82,17 +82,3 @@ def validate_two_digits(x):
     if not (1 <= a <= 9 and 1 <= b <= 9):
         raise ValueError(f"筋段が範囲外です: {x}")
     return a, b
-
-def is_move_touching_fixed_piece(mv: int, fixed_set: set):
-    """
-    mv：着手
-    fixed_set：例 {13, 19, 21}
-
-    戻り値：
-        True：mv の移動元または移動先が fixed_set に含まれる
-        False：含まれない
-    """
-    csa = cs.move_to_csa(mv)
-    frm = int(csa[0:2])
-    to  = int(csa[2:4])
-    return frm in fixed_set or to in fixed_set